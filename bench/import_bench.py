@@ -0,0 +1,89 @@
+"""
+Import-time benchmark of the remote plugin module.
+
+    python bench/import_bench.py
+    python bench/import_bench.py --runs 20 --max-ms 30
+
+The remote plugin host imports `spotify` on every start, after pynvim is
+already loaded, and then instantiates SpotifyPlugin (pynvim's Host._load).
+Each run does the same in a fresh interpreter: it imports pynvim, measures
+`import spotify` with `-X importtime`, and creates the plugin with a stub nvim
+that has credentials set. The script prints the median import and start-up
+times and the slowest modules, and exits non-zero when a module that should
+only be imported on first use (bottle, multiprocessing, distutils, requests,
+sqlite3) is loaded by either step, or when the median total exceeds --max-ms.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+PLUGIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rplugin", "python3")
+
+# Modules that must not be imported by `import spotify` or SpotifyPlugin(nvim)
+DEFERRED = ("spotify.bottle", "spotify.auth_server", "spotify.spotify_api", "multiprocessing", "distutils", "requests", "sqlite3")
+
+# Runs in the fresh interpreter; prints the microseconds SpotifyPlugin(nvim) took
+LOAD = """
+import pynvim, sys, time
+print('--', file=sys.stderr)
+import spotify
+
+class StubNvim:
+    vars = { 'spotify_client_id': 'bench', 'spotify_client_secret': 'bench' }
+
+    def command(self, command):
+        pass
+
+started = time.perf_counter()
+spotify.SpotifyPlugin(StubNvim())
+print(round((time.perf_counter() - started) * 1e6))
+"""
+
+def import_times() -> tuple[dict[str, tuple[int, int]], int]:
+    # module -> (self µs, cumulative µs) of the modules loaded by `import spotify`
+    # and by creating the plugin, and the µs the plugin took to create
+    env = dict(os.environ, PYTHONPATH=PLUGIN_PATH)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", LOAD], env=env, capture_output=True, text=True, check=True)
+    times = {}
+    lines = result.stderr.splitlines()
+    for line in lines[lines.index("--") + 1:]:
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        times[module.strip()] = (int(self_us), int(cumulative_us))
+    return times, int(result.stdout)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10, help="number of slowest modules to list")
+    parser.add_argument("--max-ms", type=float, help="fail when the median import time exceeds this")
+    args = parser.parse_args()
+
+    runs = [import_times() for _ in range(args.runs)]
+    imports = [times["spotify"][1] / 1000 for times, _ in runs]
+    starts = [start_us / 1000 for _, start_us in runs]
+    totals = [a + b for a, b in zip(imports, starts)]
+    median = statistics.median(totals)
+    print(f"import spotify: median={statistics.median(imports):.1f}ms min={min(imports):.1f}ms max={max(imports):.1f}ms ({args.runs} runs)")
+    print(f"SpotifyPlugin(nvim): median={statistics.median(starts):.1f}ms min={min(starts):.1f}ms max={max(starts):.1f}ms")
+
+    last = runs[-1][0]
+    print(f"{'module':<40} {'self':>9} {'cumulative':>11}")
+    for module, (self_us, cumulative_us) in sorted(last.items(), key=lambda item: item[1][0], reverse=True)[:args.top]:
+        print(f"{module:<40} {self_us / 1000:>7.1f}ms {cumulative_us / 1000:>9.1f}ms")
+
+    failed = False
+    loaded = [module for module in last if module.split(".")[0] in DEFERRED or module in DEFERRED]
+    if loaded:
+        print(f"FAIL: imported at start-up: {', '.join(sorted(loaded))}")
+        failed = True
+    if args.max_ms is not None and median > args.max_ms:
+        print(f"FAIL: median {median:.1f}ms exceeds {args.max_ms:.1f}ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
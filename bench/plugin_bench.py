@@ -0,0 +1,344 @@
+"""
+End-to-end benchmark of the SpotifyPlugin command handlers against the local
+Spotify stand-in (rplugin/python3/spotify/fake_api.py). The stand-in runs in a
+child process, and every scenario in a worker process of its own, so the peak
+RSS reported for a scenario is what the plugin needed for just that scenario.
+
+    python bench/plugin_bench.py
+    python bench/plugin_bench.py --sizes 50 5000 --rtts 0 0.05 --output bench_output.txt
+    python bench/plugin_bench.py --sizes 20000 --scenarios get_playlist_tracks_cold
+
+Every scenario prints one JSON object per line (to --output, or stdout) with
+p50/p95/p99 latency, requests, connections and bytes served by the stand-in, msgpack bytes
+that would cross the RPC boundary, and the peak RSS of its worker process.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rplugin", "python3"))
+
+import msgpack
+import requests
+
+from spotify import SpotifyPlugin
+from spotify.spotify_api import SpotifyApi
+
+PLUGIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rplugin", "python3")
+
+# The scenarios only open the first playlist; the others just fill the
+# playlist picker and stay small at every library size
+OTHER_PLAYLIST_SIZE = 50
+
+class StandIn:
+    # FakeSpotifyServer running in a child process (python -m spotify.fake_api),
+    # so the synthetic library does not count towards the plugin's RSS. Workers
+    # attach to the parent's stand-in by port.
+    def __init__(self, port: int, process: subprocess.Popen | None = None):
+        self.port = port
+        self.process = process
+        self.control = requests.Session()
+
+    @classmethod
+    def start(cls, liked_count: int, playlist_count: int, playlist_size: int) -> "StandIn":
+        command = [sys.executable, "-m", "spotify.fake_api", "--liked-count", str(liked_count), "--playlist-count", str(playlist_count),
+            "--playlist-size", str(playlist_size), "--other-playlist-size", str(min(playlist_size, OTHER_PLAYLIST_SIZE))]
+        process = subprocess.Popen(command, env=dict(os.environ, PYTHONPATH=PLUGIN_PATH), stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        return cls(int(process.stdout.readline()), process)
+
+    @property
+    def accounts_base(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def api_base(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def _url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.port}/_control/{path}"
+
+    def set_latency(self, latency: float):
+        self.control.post(self._url("latency"), params={ "value": latency }).raise_for_status()
+
+    def reset_stats(self):
+        self.control.post(self._url("reset")).raise_for_status()
+
+    def inject(self, status: int, count: int = 1, retry_after: float = 0):
+        # The next `count` requests fail with `status`
+        self.control.post(self._url("inject"), params={ "status": status, "count": count, "retry_after": retry_after }).raise_for_status()
+
+    def stats(self) -> dict:
+        return self.control.get(self._url("stats")).json()
+
+    def library(self) -> dict:
+        return self.control.get(self._url("library")).json()
+
+    def liked(self, index: int) -> dict:
+        return self.control.get(self._url(f"liked/{index}")).json()
+
+    def stop(self):
+        # The stand-in exits once its stdin is closed
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        self.process.wait()
+
+class BenchApi(SpotifyApi):
+    # Keeps the token file and library cache out of the plugin directory
+    data_dir: str
+
+    def __init__(self, data_dir: str, *args, **kwargs):
+        self.data_dir = data_dir
+        super().__init__(*args, **kwargs)
+
+    def _get_config_path(self):
+        return os.path.join(self.data_dir, "access_token.json")
+
+class BenchNvim:
+    # Just enough of pynvim.Nvim for the handlers
+    def __init__(self, vars: dict):
+        self.vars = vars
+        self.rpc_bytes = 0
+
+    def command(self, command: str):
+        pass
+
+    def exec_lua(self, code: str, *args):
+        self.rpc_bytes += len(msgpack.packb(args))
+
+    def async_call(self, fn, *args):
+        fn(*args)
+
+    def err_write(self, message: str):
+        sys.stderr.write(message)
+
+def percentile(samples: list[float], p: float) -> float:
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+def peak_rss_kb() -> int:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+class Bench:
+    def __init__(self, server: StandIn, iterations: int):
+        self.server = server
+        self.iterations = iterations
+        self.dirs: list[str] = []
+
+    def plugin(self) -> tuple[SpotifyPlugin, BenchNvim]:
+        # A fresh plugin with an empty library cache and an authenticated user.
+        # Without credentials in g: the plugin creates no SpotifyApi and no
+        # executor, so handlers run inline on the api set up here.
+        nvim = BenchNvim({})
+        plugin = SpotifyPlugin(nvim)
+        data_dir = tempfile.mkdtemp(prefix="spotify-bench-")
+        self.dirs.append(data_dir)
+        plugin.client_id = "bench"
+        plugin.client_secret = "bench"
+        plugin.api = BenchApi(data_dir, "bench", "bench", api_base=self.server.api_base, accounts_base=self.server.accounts_base)
+        plugin.api.authenticate("bench")
+        plugin.api.refresher.stop()
+        return plugin, nvim
+
+    def measure(self, name: str, run, setup=None, teardown=None) -> dict:
+        # `setup` builds the state for one iteration and is not timed.
+        # `teardown` waits for background work the iteration started, so its
+        # requests are counted here and not in the next scenario.
+        samples = []
+        self.server.reset_stats()
+        rpc_bytes = 0
+        for _ in range(self.iterations):
+            plugin, nvim = self.plugin()
+            state = setup(plugin) if setup is not None else None
+            self.server.reset_stats()
+            nvim.rpc_bytes = 0
+            started = time.perf_counter()
+            result = run(plugin, state)
+            samples.append((time.perf_counter() - started) * 1000)
+            if teardown is not None:
+                teardown(plugin)
+            # Return values of sync functions cross the RPC boundary as well
+            if result is not None:
+                nvim.rpc_bytes += len(msgpack.packb(result))
+            rpc_bytes += nvim.rpc_bytes
+        stats = self.server.stats()
+        return {
+            "scenario": name,
+            "iterations": self.iterations,
+            "p50_ms": round(percentile(samples, 50), 3),
+            "p95_ms": round(percentile(samples, 95), 3),
+            "p99_ms": round(percentile(samples, 99), 3),
+            # Server counters cover the last iteration only
+            "requests": stats["total_requests"],
+            "bytes": stats["bytes_out"],
+            "connections": stats["connections"],
+            "rpc_bytes": rpc_bytes // self.iterations,
+            "peak_rss_kb": peak_rss_kb(),
+        }
+
+    def run(self, name: str) -> dict:
+        return self.measure(name, *self.scenarios()[name])
+
+    def scenarios(self) -> dict[str, tuple]:
+        # name -> (run, setup, teardown) as taken by `measure`
+        library = self.server.library()
+        playlist_id = library["playlist_ids"][0]
+        liked_uri = self.server.liked(library["liked_count"] // 2)["track"]["uri"] if library["liked_count"] else None
+
+        def warm_tracks(plugin):
+            plugin.get_playlist_tracks([playlist_id])
+
+        def warm_liked(plugin):
+            plugin.get_playlist_tracks(["__liked__"])
+
+        def async_mode(plugin):
+            # The executor g:spotify_async = 1 creates. Handlers then only hand
+            # their work off, so what is measured is how long they hold the
+            # RPC thread; the work itself finishes in `wait_background`.
+            plugin.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="spotify")
+
+        def wait_background(plugin):
+            if plugin.playback is not None:
+                plugin.playback.stop()
+            plugin.executor.shutdown()
+
+        def play_pause(plugin, _):
+            plugin.play([])
+            plugin.pause()
+
+        # Ten calls over a new connection each, as before the shared session,
+        # against the same calls through the keep-alive pool
+        def profile_fresh_connections(plugin, _):
+            for _ in range(10):
+                requests.get(f"{plugin.api.api_base}/me", headers=dict(plugin.api.session.headers)).raise_for_status()
+
+        def profile_pooled(plugin, _):
+            for _ in range(10):
+                plugin.api._get_profile()
+
+        def stream_tracks(plugin, _):
+            plugin.stream_playlist_tracks([playlist_id, 1])
+
+        def watch_first_page(plugin):
+            # `stream_until_first_page` returns once the first page has gone
+            # through exec_lua, as recorded in the plugin's stream_first_page
+            async_mode(plugin)
+            pushed = threading.Event()
+            exec_lua = plugin.nvim.exec_lua
+
+            def push(code, *args):
+                exec_lua(code, *args)
+                if "appendTracks" in code:
+                    pushed.set()
+            plugin.nvim.exec_lua = push
+            return pushed
+
+        # Spotify answers 429 with Retry-After, which the scheduler must wait
+        # out before trying again (two requests, at least 200 ms)
+        def throttle_once(plugin):
+            self.server.inject(429, retry_after=0.2)
+
+        # A 502 to POST /me/player/queue may have queued the track anyway, so
+        # it must not be retried (one request, the error reported)
+        def fail_queue_once(plugin):
+            self.server.inject(502)
+
+        def queue_track(plugin, _):
+            try:
+                plugin.add_to_queue([f"spotify:track:{playlist_id}-0"])
+            except Exception:
+                pass
+
+        def stream_until_first_page(plugin, pushed):
+            stream_tracks(plugin, None)
+            pushed.wait()
+
+        return {
+            "auth": (lambda plugin, _: plugin._request_access_token("bench"),),
+            "profile_x10_fresh_connections": (profile_fresh_connections,),
+            "profile_x10_pooled": (profile_pooled,),
+            "getPlaylists": (lambda plugin, _: plugin.getPlaylists(),),
+            "getPlaylists_after_429": (lambda plugin, _: plugin.getPlaylists(), throttle_once),
+            "queue_after_502": (queue_track, fail_queue_once),
+            "play_resume": (lambda plugin, _: plugin.play([]),),
+            "play_playlist_track": (lambda plugin, _: plugin.play([f"spotify:playlist:{playlist_id}", f"spotify:track:{playlist_id}-0"]),),
+            "play_liked_track": (lambda plugin, _: plugin.play(["__liked__", liked_uri]),),
+            "play_pause_dispatch_return": (play_pause, async_mode, wait_background),
+            # Time the RPC thread is blocked by a handler, with g:spotify_async = 0
+            # (no executor, the handler does the requests itself) and = 1
+            "rpc_blocked_getPlaylists_sync": (lambda plugin, _: plugin.getPlaylists(),),
+            "rpc_blocked_getPlaylists_async": (lambda plugin, _: plugin.getPlaylists(), async_mode, wait_background),
+            "rpc_blocked_stream_tracks_sync": (stream_tracks,),
+            "rpc_blocked_stream_tracks_async": (stream_tracks, async_mode, wait_background),
+            "stream_first_page": (stream_until_first_page, watch_first_page, wait_background),
+            "get_playlist_tracks_cold": (lambda plugin, _: plugin.get_playlist_tracks([playlist_id]),),
+            "get_playlist_tracks_warm": (lambda plugin, _: plugin.get_playlist_tracks([playlist_id]), warm_tracks),
+            "get_liked_tracks_cold": (lambda plugin, _: plugin.get_playlist_tracks(["__liked__"]),),
+            "get_liked_tracks_warm": (lambda plugin, _: plugin.get_playlist_tracks(["__liked__"]), warm_liked),
+        }
+
+    def cleanup(self):
+        for data_dir in self.dirs:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+def run_worker(port: int, scenario: str, iterations: int) -> dict:
+    # Runs one scenario in a fresh interpreter against the parent's stand-in
+    command = [sys.executable, os.path.abspath(__file__), "--worker", scenario, "--port", str(port), "--iterations", str(iterations)]
+    result = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True)
+    return json.loads(result.stdout)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 1000, 5000, 20000], help="library sizes: saved tracks and tracks in the playlist under test")
+    parser.add_argument("--rtts", type=float, nargs="+", default=[0, 0.02, 0.1], help="simulated round-trip times in seconds")
+    parser.add_argument("--playlists", type=int, default=20, help="number of playlists")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--scenarios", nargs="+", help="run only these scenarios")
+    parser.add_argument("--output", help="append JSON lines here instead of printing them")
+    # Internal: run one scenario as a worker process
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        bench = Bench(StandIn(args.port), args.iterations)
+        try:
+            print(json.dumps(bench.run(args.worker)))
+        finally:
+            bench.cleanup()
+        return
+
+    out = open(args.output, "a") if args.output else sys.stdout
+    for size in args.sizes:
+        server = StandIn.start(liked_count=size, playlist_count=args.playlists, playlist_size=size)
+        try:
+            names = list(Bench(server, args.iterations).scenarios())
+            unknown = set(args.scenarios or []) - set(names)
+            if unknown:
+                parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+            for rtt in args.rtts:
+                server.set_latency(rtt)
+                for name in args.scenarios or names:
+                    result = run_worker(server.port, name, args.iterations)
+                    result.update(size=size, rtt_ms=rtt * 1000)
+                    out.write(json.dumps(result) + "\n")
+                    out.flush()
+                    print(f"{result['scenario']:<30} size={size:<6} rtt={rtt * 1000:>5.0f}ms  p50={result['p50_ms']:>9.1f}ms  p95={result['p95_ms']:>9.1f}ms  requests={result['requests']:<4} connections={result['connections']:<3} bytes={result['bytes']:<8} rss={result['peak_rss_kb'] // 1024}MB", file=sys.stderr)
+        finally:
+            server.stop()
+    if out is not sys.stdout:
+        out.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Stress test of the single-flight token refresh across threads and processes,
+against the local Spotify stand-in (rplugin/python3/spotify/fake_api.py).
+
+    python bench/token_refresh_stress.py
+    python bench/token_refresh_stress.py --processes 8 --threads 16 --latency 0.05
+
+M worker processes share one token file holding an expired token, and N threads
+in each call the API at the same moment. Every scenario must hit the token
+endpoint exactly once and leave every process with a valid token. Scenarios:
+
+    expired     every instance loaded the expired token from the file
+    stale-file  instances hold an older expired token than the file, which
+                has expired too and must not be adopted
+
+Prints one JSON object per scenario and exits non-zero if any scenario did not
+refresh exactly once or sent a request with an expired token.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rplugin", "python3"))
+
+from spotify.fake_api import FakeSpotifyServer
+from spotify.spotify_api import SpotifyApi
+
+SCENARIOS = ("expired", "stale-file")
+
+class StressApi(SpotifyApi):
+    data_dir: str
+
+    def __init__(self, data_dir: str, *args, **kwargs):
+        self.data_dir = data_dir
+        super().__init__(*args, **kwargs)
+
+    def _get_config_path(self):
+        return os.path.join(self.data_dir, "access_token.json")
+
+    def _get_cache_path(self):
+        # One cache per process, so the workers only share the token file
+        return os.path.join(self.data_dir, f"library-{os.getpid()}.sqlite3")
+
+def write_token(data_dir: str, expires_at: int):
+    with open(os.path.join(data_dir, "access_token.json"), "w") as f:
+        json.dump({
+            "access_token": f"expired-{expires_at}",
+            "token_type": "Bearer",
+            "expires_in": 3600,
+            "expires_at": expires_at,
+            "refresh_token": "fake-refresh",
+            "user_id": "fake-user",
+        }, f)
+
+def worker(args):
+    # Runs in a worker process: load the shared token and call the API from
+    # every thread once the common start time is reached
+    api = StressApi(args.data_dir, "stress", "stress", api_base=args.api_base, accounts_base=args.accounts_base)
+    # Only the foreground calls may refresh; load_user would start the
+    # background refresher, which could get there first
+    api.refresher.start = lambda: None
+    api.load_user()
+    if args.scenario == "stale-file":
+        api.access_token = "older-expired"
+        api.expires_at = int(time.time()) - 3 * 3600
+        api._update_auth_header()
+
+    errors = []
+    barrier = threading.Barrier(args.threads)
+
+    def call():
+        barrier.wait()
+        try:
+            api._get_profile()
+        except Exception as e:
+            errors.append(e)
+
+    time.sleep(max(0, args.start_at - time.time()))
+    threads = [threading.Thread(target=call) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Every instance must end up with a token that is actually valid
+    valid = api.expires_at is not None and api.expires_at - 60 > time.time()
+    sys.exit(1 if errors or not valid else 0)
+
+def run_scenario(server: FakeSpotifyServer, scenario: str, processes: int, threads: int) -> dict:
+    data_dir = tempfile.mkdtemp(prefix="spotify-refresh-")
+    try:
+        # Expired an hour ago; in "stale-file" the instances hold an even older token
+        write_token(data_dir, int(time.time()) - 3600)
+        server.reset_stats()
+        start_at = time.time() + 1 + processes * 0.2
+        command = [sys.executable, os.path.abspath(__file__), "--worker",
+            "--data-dir", data_dir, "--api-base", server.api_base, "--accounts-base", server.accounts_base,
+            "--scenario", scenario, "--threads", str(threads), "--start-at", str(start_at)]
+        workers = [subprocess.Popen(command) for _ in range(processes)]
+        failed_workers = sum(1 for process in workers if process.wait() != 0)
+        stats = server.stats()
+        return {
+            "scenario": scenario,
+            "processes": processes,
+            "threads": threads,
+            "token_requests": stats["requests"].get("/api/token", 0),
+            "profile_requests": stats["requests"].get("/v1/me", 0),
+            # Calls sent with an expired token, e.g. one adopted from the file
+            "unauthorized": stats["unauthorized"],
+            "failed_workers": failed_workers,
+        }
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated round-trip time in seconds")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    # Internal: run as one of the worker processes
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--scenario", help=argparse.SUPPRESS)
+    parser.add_argument("--data-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--api-base", help=argparse.SUPPRESS)
+    parser.add_argument("--accounts-base", help=argparse.SUPPRESS)
+    parser.add_argument("--start-at", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        return
+
+    failed = False
+    with FakeSpotifyServer(latency=args.latency) as server:
+        for scenario in args.scenarios:
+            result = run_scenario(server, scenario, args.processes, args.threads)
+            print(json.dumps(result))
+            if result["token_requests"] != 1 or result["unauthorized"] or result["failed_workers"]:
+                failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,52 @@
 local M = {}
 
+local function trackEntry(entry)
+  return {
+    value = entry,
+    display = entry.name,
+    ordinal = entry.name,
+  }
+end
+
+local function trackFinder(songs)
+  local finders = require "telescope.finders"
+
+  return finders.new_table {
+    results = songs,
+    entry_maker = trackEntry,
+  }
+end
+
+-- Finder over a list of tracks that keeps growing. Unlike new_table, which
+-- makes an entry for every track each time it is built, entries are made once,
+-- so refreshing after a page only pays for the tracks of that page.
+local function growingTrackFinder(songs)
+  local entries = {}
+  return setmetatable({
+    close = function() end,
+  }, {
+    __call = function(_, _, process_result, process_complete)
+      for i = #entries + 1, #songs do
+        entries[i] = trackEntry(songs[i])
+      end
+      for _, entry in ipairs(entries) do
+        if process_result(entry) then
+          return
+        end
+      end
+      process_complete()
+    end,
+  })
+end
+
 M.showTracks = function (playlist_uri, songs)
   local pickers = require "telescope.pickers"
-  local finders = require "telescope.finders"
   local sorters = require "telescope.sorters"
   local actions = require('telescope.actions')
 
-  pickers.new({}, {
+  local picker = pickers.new({}, {
     prompt_title = "Tracks",
-    finder = finders.new_table {
-      results = songs,
-      entry_maker = function(entry)
-        return {
-          value = entry,
-          display = entry.name,
-          ordinal = entry.name,
-        }
-      end,
-    },
+    finder = trackFinder(songs),
     sorter = sorters.get_generic_fuzzy_sorter({}),
     attach_mappings = function(prompt_bufnr, map)
       actions.select_default:replace(function()
@@ -26,9 +55,18 @@ M.showTracks = function (playlist_uri, songs)
         vim.print("SpotifyPlay " .. playlist_uri .. " " .. selection.value.uri)
         vim.api.nvim_command("SpotifyPlay " .. playlist_uri .. " " .. selection.value.uri)
       end)
+      -- Queue the selection and keep the picker open for more
+      map('i', '<C-q>', function()
+        local selection = require('telescope.actions.state').get_selected_entry()
+        if selection ~= nil then
+          vim.api.nvim_command("SpotifyQueue " .. selection.value.uri)
+        end
+      end)
       return true
     end,
-  }):find()
+  })
+  picker:find()
+  return picker
 end
 
 M.showPlaylists = function (playlists)
@@ -60,9 +98,26 @@ M.showPlaylists = function (playlists)
       map('i', '<C-d>', function()
         actions.close(prompt_bufnr)
         local selection = require('telescope.actions.state').get_selected_entry()
-        local tracks = M.getPlaylistTracks(selection.value.id)
-        M.showTracks(selection.value.uri, tracks)
+        M.loadPlaylistTracks(selection.value.id, selection.value.uri)
       end)
+      -- Let the plugin prefetch the tracks around the highlighted playlist
+      local function moveAndPrefetch(move)
+        return function()
+          move(prompt_bufnr)
+          local selection = require('telescope.actions.state').get_selected_entry()
+          if selection ~= nil then
+            vim.fn.SpotifyPrefetchPlaylist(selection.value.id)
+          end
+        end
+      end
+      for _, key in ipairs({ '<Down>', '<C-n>' }) do
+        map('i', key, moveAndPrefetch(actions.move_selection_next))
+      end
+      for _, key in ipairs({ '<Up>', '<C-p>' }) do
+        map('i', key, moveAndPrefetch(actions.move_selection_previous))
+      end
+      map('n', 'j', moveAndPrefetch(actions.move_selection_next))
+      map('n', 'k', moveAndPrefetch(actions.move_selection_previous))
       return true
     end,
   }):find()
@@ -73,4 +128,182 @@ M.getPlaylistTracks = function (playlistId)
   return p
 end
 
+-- Open track pickers that are still receiving pages, by stream id
+M.streams = {}
+local nextStreamId = 0
+
+-- Pages arriving within this many milliseconds of the last refresh are shown
+-- together by the next one; every refresh re-sorts the whole list
+M.streamRefreshMs = 100
+
+-- Opens the track picker right away; the plugin then pushes pages of tracks
+-- into it through appendTracks as they are fetched
+M.loadPlaylistTracks = function (playlistId, playlistUri)
+  nextStreamId = nextStreamId + 1
+  local stream = { results = {}, dirty = false, refreshScheduled = false }
+  stream.finder = growingTrackFinder(stream.results)
+  stream.picker = M.showTracks(playlistUri, stream.results)
+  M.streams[nextStreamId] = stream
+  vim.api.nvim_call_function("SpotifyStreamPlaylistTracks", { playlistId, nextStreamId })
+end
+
+local function refreshStream(stream)
+  stream.dirty = false
+  stream.refreshScheduled = false
+  stream.refreshedAt = vim.loop.now()
+  if vim.api.nvim_buf_is_valid(stream.picker.prompt_bufnr) then
+    stream.picker:refresh(stream.finder, { reset_prompt = false })
+  end
+end
+
+M.appendTracks = function (streamId, tracks, done, failed)
+  local stream = M.streams[streamId]
+  if stream == nil then
+    return
+  end
+  if done then
+    M.streams[streamId] = nil
+  end
+  if not vim.api.nvim_buf_is_valid(stream.picker.prompt_bufnr) then
+    -- The picker was closed before all pages arrived
+    M.streams[streamId] = nil
+    return
+  end
+  if failed and #stream.results == 0 then
+    -- Nothing to pick from; the plugin has echoed why
+    require('telescope.actions').close(stream.picker.prompt_bufnr)
+    return
+  end
+
+  vim.list_extend(stream.results, tracks)
+  if #tracks > 0 then
+    stream.dirty = true
+  end
+  if not stream.dirty or stream.refreshScheduled then
+    -- A scheduled refresh shows these tracks as well
+    return
+  end
+  -- The first page and the end of the stream are shown right away
+  local wait = 0
+  if stream.refreshedAt ~= nil and not done then
+    wait = stream.refreshedAt + M.streamRefreshMs - vim.loop.now()
+  end
+  if wait <= 0 then
+    refreshStream(stream)
+  else
+    stream.refreshScheduled = true
+    vim.defer_fn(function () refreshStream(stream) end, wait)
+  end
+end
+
+-- Milliseconds to wait after the last keystroke before searching
+M.searchDebounceMs = 250
+
+local search = { requestId = 0 }
+
+M.showSearch = function (type)
+  local pickers = require "telescope.pickers"
+  local sorters = require "telescope.sorters"
+  local actions = require('telescope.actions')
+
+  local timer = vim.loop.new_timer()
+  local lastQuery = nil
+
+  local picker = pickers.new({}, {
+    prompt_title = "Spotify Search (" .. type .. ")",
+    finder = trackFinder({}),
+    -- Results come ranked from Spotify; don't filter them again locally
+    sorter = sorters.empty(),
+    on_input_filter_cb = function(prompt)
+      if prompt ~= lastQuery then
+        lastQuery = prompt
+        timer:stop()
+        timer:start(M.searchDebounceMs, 0, vim.schedule_wrap(function ()
+          search.requestId = search.requestId + 1
+          vim.fn.SpotifySearchQuery(prompt, type, search.requestId)
+        end))
+      end
+      return { prompt = prompt }
+    end,
+    attach_mappings = function(prompt_bufnr, map)
+      actions.select_default:replace(function()
+        actions.close(prompt_bufnr)
+        local selection = require('telescope.actions.state').get_selected_entry()
+        if selection == nil then
+          return
+        end
+        vim.api.nvim_command("SpotifyPlay " .. selection.value.uri)
+      end)
+      vim.api.nvim_create_autocmd("BufWipeout", {
+        buffer = prompt_bufnr,
+        once = true,
+        callback = function ()
+          timer:stop()
+          timer:close()
+          search.picker = nil
+        end,
+      })
+      return true
+    end,
+  })
+  search.picker = picker
+  picker:find()
+end
+
+M.setSearchResults = function (requestId, results)
+  -- Drop results of queries that were superseded while in flight
+  if search.picker == nil or requestId ~= search.requestId then
+    return
+  end
+  search.picker:refresh(trackFinder(results), { reset_prompt = false })
+end
+
+-- Last player state pushed by the plugin's poller, nil when nothing is playing
+M.nowPlayingState = nil
+-- Set once the plugin confirms its poller runs; until then nowPlaying asks
+-- again every nowPlayingRetryMs, e.g. while :SpotifyAuth has not been run yet
+local nowPlayingStarted = false
+local nowPlayingRequestedAt = nil
+M.nowPlayingRetryMs = 30000
+
+M.onNowPlayingStarted = function ()
+  nowPlayingStarted = true
+end
+
+M.setNowPlaying = function (state)
+  if state ~= nil then
+    state.received_at = vim.loop.now()
+  end
+  M.nowPlayingState = state
+end
+
+local function formatTime(ms)
+  local seconds = math.floor(ms / 1000)
+  return string.format("%d:%02d", math.floor(seconds / 60), seconds % 60)
+end
+
+-- For statuslines and winbars: never waits on the network. The progress is
+-- extrapolated from the last poll while the track is playing.
+M.nowPlaying = function ()
+  local now = vim.loop.now()
+  if not nowPlayingStarted and (nowPlayingRequestedAt == nil or now - nowPlayingRequestedAt >= M.nowPlayingRetryMs) then
+    nowPlayingRequestedAt = now
+    vim.schedule(function ()
+      vim.fn.SpotifyStartNowPlaying()
+    end)
+  end
+
+  local state = M.nowPlayingState
+  if state == nil then
+    return ""
+  end
+
+  local progress = state.progress_ms
+  if state.is_playing then
+    progress = math.min(state.duration_ms, progress + now - state.received_at)
+  end
+  local icon = state.is_playing and "▶" or "⏸"
+  return string.format("%s %s - %s %s/%s", icon, state.artists, state.name, formatTime(progress), formatTime(state.duration_ms))
+end
+
 return M
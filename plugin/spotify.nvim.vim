@@ -0,0 +1,4 @@
+" Current track for statuslines/winbars, e.g. set statusline+=%{SpotifyNowPlaying()}
+function! SpotifyNowPlaying() abort
+  return luaeval("require('spotify').nowPlaying()")
+endfunction
@@ -1,51 +1,38 @@
+from __future__ import annotations
+
+import json
+import threading
 import time
-from typing import OrderedDict
-from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
 import os
 import pynvim
+import shutil
 
-from . import bottle
-from .spotify_api import SpotifyApi
-import multiprocessing
-import random
-import distutils.spawn
-import platform
-
-scopes = ["user-read-playback-state", "user-modify-playback-state", "user-read-currently-playing", "playlist-read-private", "playlist-read-collaborative", "user-library-read"]
-
-def jump(state, client_id):
-    def _jump():
-        q = OrderedDict(
-            response_type="code",
-            client_id=client_id,
-            scope=" ".join(scopes),
-            redirect_uri="http://localhost:8080/auth",
-            state=state
-        )
-        queryString = urlencode(q)
-        bottle.redirect(f"https://accounts.spotify.com/authorize?{queryString}")
-    return _jump
-
-def auth(value, state):
-    def _auth():
-        try:
-            code = bottle.request.query['code']
-            s = bottle.request.query['state']
-            if s != state:
-                return f"Invalid state: {s} != {state}"
-            value.value = code
-        except Exception as e:
-            return e
-        return "Authenticated!"
-    return _auth
-
-def startServer(value, client_id):
-    b = bottle.Bottle()
-    bottle.debug(True)
-    state = "".join(random.choices("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789", k=16))
-    b.route('/auth', 'GET', auth(value, state))
-    b.route('/', 'GET', jump(state, client_id))
-    b.run(host='localhost', port=8080)
+from . import deadline
+from .metrics import render_stats
+from .now_playing import NowPlayingPoller
+from .playback import PlaybackDispatcher
+from .prefetch import PlaylistPrefetcher
+
+# The remote plugin host imports this module and instantiates SpotifyPlugin on
+# every start, so the heavy modules (bottle via auth_server, platform, requests
+# and sqlite3 via spotify_api) are imported where they are first needed.
+# bench/import_bench.py keeps it that way.
+if TYPE_CHECKING:
+    from .auth_server import AuthCallbackServer
+    from .spotify_api import SpotifyApi
+
+# Upper bound on the track list sent in a single play request
+MAX_PLAY_URIS = 500
+
+SEARCH_TYPES = ["track", "album", "playlist", "artist"]
+
+# How long :SpotifyAuth waits for the browser to come back with a code
+AUTH_TIMEOUT = 300
+
+# Seconds a command may take in total, retries and pagination included
+COMMAND_TIMEOUT = 30
 
 @pynvim.plugin
 class SpotifyPlugin:
@@ -54,66 +41,184 @@ class SpotifyPlugin:
 
     client_id: str | None = None
     client_secret: str | None = None
+    executor: ThreadPoolExecutor | None = None
+    # The callback server of a :SpotifyAuth still waiting for the browser
+    auth_server: AuthCallbackServer | None = None
+    command_timeout: float = COMMAND_TIMEOUT
+    now_playing: NowPlayingPoller | None = None
+    # Set once a statusline asked for the current track, so :SpotifyAuth can
+    # start the poller it could not start before
+    now_playing_wanted: bool = False
+    playback: PlaybackDispatcher | None = None
+    prefetcher: PlaylistPrefetcher | None = None
+    # Id of the newest search query; older ones are dropped before or after the request
+    latest_search: int = 0
 
     def __init__(self, nvim):
+        # Only the credentials are read here; the host creates the plugin while
+        # it starts, and everything else is set up by `_get_api` on first use
         self.nvim = nvim
-        if 'spotify_client_id' in self.nvim.vars and 'spotify_client_secret' in self.nvim.vars:
-            self.client_id = self.nvim.vars['spotify_client_id']
-            self.client_secret = self.nvim.vars['spotify_client_secret']
-            self.api = SpotifyApi(self.client_id, self.client_secret)
-        else:
+        self.client_id = self.nvim.vars.get('spotify_client_id')
+        self.client_secret = self.nvim.vars.get('spotify_client_secret')
+        if self.client_id is None or self.client_secret is None:
             self.nvim.command('echo "Please set client_id and client_secret"')
-            return
+
+    def _get_api(self) -> SpotifyApi | None:
+        # Creates the API client, its library cache and the worker threads the
+        # first time a command needs them
+        if self.api is not None or self.client_id is None or self.client_secret is None:
+            return self.api
+
+        pool_size = self.nvim.vars.get('spotify_pool_size', 10)
+        max_concurrency = self.nvim.vars.get('spotify_max_concurrency', 4)
+        track_fields = self.nvim.vars.get('spotify_track_fields', 'name,uri')
+        api_base = self.nvim.vars.get('spotify_api_base', 'https://api.spotify.com/v1')
+        accounts_base = self.nvim.vars.get('spotify_accounts_base', 'https://accounts.spotify.com')
+        from .spotify_api import SpotifyApi
+        api = SpotifyApi(self.client_id, self.client_secret, pool_size, max_concurrency, track_fields, api_base, accounts_base)
+        api.breaker.on_change = self._report_circuit
+        self.command_timeout = self.nvim.vars.get('spotify_command_timeout', COMMAND_TIMEOUT)
+        if self.nvim.vars.get('spotify_prefetch', 1):
+            self.prefetcher = PlaylistPrefetcher(api)
+        if self.nvim.vars.get('spotify_async', 1):
+            self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="spotify")
+        self.api = api
+        return api
 
     def _request_access_token(self, code):
-        if self.client_id is None or self.client_secret is None or self.api is None:
+        api = self._get_api()
+        if api is None:
             self.nvim.command('echo "Please set client_id and client_secret"')
             return (None, None, None, None)
         
-        return self.api.authenticate(code)
+        return api.authenticate(code)
 
-    def _check_auth(self) -> SpotifyApi | None:
-        if self.api is None:
-            self.nvim.command('echo "Please set client_id and client_secret"')
+    def _check_auth(self, quiet: bool = False) -> SpotifyApi | None:
+        # `quiet` is for calls the user did not make, e.g. from a statusline
+        api = self._get_api()
+        if api is None:
+            if not quiet:
+                self.nvim.command('echo "Please set client_id and client_secret"')
             return None
 
-        if self.api.access_token is None:
-            self.api.load_user()
-            if self.api.access_token is None:
-                self.nvim.command('echo "Not authenticated yet, please run :SpotifyAuth first"')
+        if api.access_token is None:
+            api.load_user()
+            if api.access_token is None:
+                if not quiet:
+                    self.nvim.command('echo "Not authenticated yet, please run :SpotifyAuth first"')
                 return None
-        return self.api
+        return api
 
     @pynvim.command('SpotifyAuth')
     def auth(self):
-        api = self._check_auth()
+        api = self._get_api()
         if api is None:
             self.nvim.command('echo "Please set client_id and client_secret"')
-            return;
+            return
+
+        import platform
+        from .auth_server import AuthCallbackServer
 
-        value = multiprocessing.Manager().Value('s', None)
-        proc = multiprocessing.Process(target=startServer, args=(value, self.client_id), daemon=True)
-        proc.start()
+        # A new :SpotifyAuth (e.g. after closing the browser tab) replaces the
+        # pending one, which frees its port and ends its wait
+        if self.auth_server is not None:
+            self.auth_server.stop()
+            self.auth_server = None
+
+        # g:spotify_auth_port must match the redirect URI registered for the
+        # app; 0 binds any free port for apps that allow one
+        port = self.nvim.vars.get('spotify_auth_port', 8080)
+        try:
+            server = AuthCallbackServer(self.client_id, api.accounts_base, port=port).start()
+        except OSError as e:
+            self._echo_error(Exception(f"Could not start the authentication server on port {port}: {e}"))
+            return
+        self.auth_server = server
 
         if platform.system() == 'Windows':
-            os.system('start http://localhost:8080')
-        elif distutils.spawn.find_executable('xdg-open'):
-            os.system('xdg-open http://localhost:8080')
-        elif distutils.spawn.find_executable('open'):
-            os.system('open http://localhost:8080')
+            os.system(f'start {server.url}')
+        elif shutil.which('xdg-open'):
+            os.system(f'xdg-open {server.url}')
+        elif shutil.which('open'):
+            os.system(f'open {server.url}')
         else:
-            self.nvim.command('echo "Could not open browser, please open it manually and navigate to http://localhost:8080"')
+            self.nvim.command(f'echo "Could not open browser, please open it manually and navigate to {server.url}"')
+
+        def work():
+            try:
+                code = server.wait(AUTH_TIMEOUT)
+            finally:
+                server.stop()
+            if self.auth_server is not server:
+                # Replaced by a newer :SpotifyAuth
+                return False
+            self.auth_server = None
+            if code is None:
+                raise Exception("Timed out waiting for the browser, please run :SpotifyAuth again")
+            self.nvim.async_call(self._echo, "Getting access token...")
+            # The command budget starts once the browser is back
+            with deadline.within(self.command_timeout):
+                api.authenticate(code, server.redirect_uri)
+            return True
+
+        def done(authenticated):
+            if authenticated:
+                self._echo("Authenticated!")
+                if self.now_playing_wanted:
+                    self._start_now_playing(api)
+
+        # The wait can take minutes, so it gets its own thread rather than
+        # holding one of the executor's workers
+        threading.Thread(target=self._run_job, args=(work, done), name="spotify-auth-wait", daemon=True).start()
+
+    def _echo(self, message: str):
+        self.nvim.command(f'echo "{message}"')
+
+    def _echo_error(self, error: Exception):
+        self.nvim.err_write(f"Spotify: {error}\n")
+
+    def _report_circuit(self, state: str):
+        # Called from whichever thread tripped or closed the circuit breaker
+        if state == "open":
+            message = f"Spotify is not responding, commands fail immediately for the next {self.api.breaker.reset_timeout:.0f}s (degraded mode)"
+            self.nvim.async_call(self._echo_error, Exception(message))
+        else:
+            self.nvim.async_call(self._echo, "Spotify is reachable again")
+
+    def _run_job(self, work, on_done):
+        try:
+            result = work()
+        except Exception as e:
+            self.nvim.async_call(self._echo_error, e)
             return
+        if on_done is not None:
+            self.nvim.async_call(on_done, result)
 
-        result = None
-        while result == None:
-            time.sleep(1)
-            result = value.get()
-            pass
-        proc.kill()
-        self.nvim.command('echo "Getting access token..."')
-        api.authenticate(result)
-        self.nvim.command(f'echo "Authenticated!"')
+    def _post(self, fn, *args):
+        # Calls `fn` on the event loop; used by jobs that report progress
+        if self.executor is None:
+            fn(*args)
+        else:
+            self.nvim.async_call(fn, *args)
+
+    def _bounded(self, work):
+        def run():
+            with deadline.within(self.command_timeout):
+                return work()
+        return run
+
+    def _dispatch(self, work, on_done=None):
+        # Runs `work` off the RPC thread and hands its result to `on_done` back on
+        # the event loop, where it is safe to talk to Neovim again. With
+        # g:spotify_async = 0 everything runs inline like before. `work` has to
+        # finish within g:spotify_command_timeout.
+        work = self._bounded(work)
+        if self.executor is None:
+            result = work()
+            if on_done is not None:
+                on_done(result)
+            return
+        self.executor.submit(self._run_job, work, on_done)
 
     @pynvim.command("SpotifyPlaylist")
     def getPlaylists(self):
@@ -121,72 +226,162 @@ class SpotifyPlugin:
         if api is None:
             return
 
-        names = api.get_playlists()
-        names.append({ "name": "Liked Songs", "uri": "__liked__", "id": "__liked__" })
-
-        self.nvim.exec_lua("require('spotify').showPlaylists(...)", names)
-        pass
-
-    def _get_liked_songs(self):
+        def work():
+            names = api.get_playlists()
+            if self.prefetcher is not None:
+                self.prefetcher.start_session([playlist['id'] for playlist in names])
+            return names
+
+        def show(names):
+            names.append({ "name": "Liked Songs", "uri": "__liked__", "id": "__liked__" })
+            self.nvim.exec_lua("require('spotify').showPlaylists(...)", names)
+
+        self._dispatch(work, show)
+
+    @pynvim.function("SpotifyPrefetchPlaylist")
+    def prefetch_playlist(self, args):
+        # The playlist picker calls this whenever the selection moves
+        if self.prefetcher is not None:
+            self.prefetcher.focus(args[0])
+
+    def _note_open(self, id: str):
+        if self.prefetcher is not None:
+            self.prefetcher.note_open(id)
+
+    def _playback(self) -> PlaybackDispatcher:
+        # Playback commands go through one ordered, coalescing worker instead of
+        # the shared executor, where a later pause could overtake a play
+        if self.playback is None:
+            self.playback = PlaybackDispatcher(
+                lambda args: self._play(self.api, args),
+                lambda: self.api.pause(),
+                lambda uri: self.api.add_to_queue(uri),
+                lambda message: self.nvim.async_call(self._playback_done, message),
+                lambda error: self.nvim.async_call(self._echo_error, error),
+                self.api.metrics,
+                self.command_timeout,
+            )
+        return self.playback
+
+    def _playback_done(self, message):
+        self._poke_now_playing()
+        if message is not None:
+            self._echo(message)
+
+    def _record_command(self, name: str, started: float):
+        if self.api is not None:
+            self.api.metrics.record_command(name, (time.perf_counter() - started) * 1000)
+
+    @pynvim.command("SpotifyQueue", nargs=1)
+    def add_to_queue(self, args):
+        started = time.perf_counter()
         api = self._check_auth()
         if api is None:
             return
 
-        return api.get_liked_songs()
+        if self.executor is None:
+            self._dispatch(lambda: api.add_to_queue(args[0]), lambda _: self._echo("Queued"))
+        else:
+            self._playback().add_to_queue(args[0])
+        self._record_command("SpotifyQueue", started)
 
-    def _get_liked_songs_uris(self):
-        api = self._check_auth()
-        if api is None:
-            return
+    def _play(self, api: SpotifyApi, args):
+        if len(args) == 0:
+            api.play()
+            return "resume playing"
+
+        context_uri = args[0]
+        uri = len(args) > 1 and args[1] or None
+        if context_uri == "__liked__":
+            self._play_liked(api, uri)
+            return None
 
-        return [track['uri'] for track in api.get_liked_songs()]
+        if context_uri.startswith("spotify:track:"):
+            # Tracks are not a context; play them as a one-item list
+            api.play([context_uri])
+            return None
 
-    def _add_to_queue(self, uri):
-        api = self._check_auth()
-        if api is None:
+        api.play(context_uri, uri)
+        if uri is None:
+            return f"Playing uri: {context_uri}"
+        return None
+
+    def _play_liked(self, api: SpotifyApi, uri: str | None):
+        # Liked Songs can be played as the user's collection context, which needs
+        # no library download. Should the player reject that context (400), fall
+        # back to an explicit, bounded window of the library starting at `uri`.
+        # Anything else, e.g. 404 "No active device" or a 429, would fail the
+        # fallback just the same, so it is raised right away.
+        from .spotify_api import SpotifyApiError
+
+        try:
+            api.play(api.liked_songs_context(), uri)
             return
+        except SpotifyApiError as e:
+            if e.status_code != 400:
+                raise
 
-        api.add_to_queue(uri)
+        uris = [track.uri for track in api.get_liked_songs()]
+        start = uris.index(uri) if uri in uris else 0
+        api.play(uris[start:start + MAX_PLAY_URIS])
 
     @pynvim.command("SpotifyPlay", nargs="*")
     def play(self, args):
+        started = time.perf_counter()
         api = self._check_auth()
         if api is None:
             return
 
-        if len(args) == 0:
-            api.play()
-            self.nvim.command(f'echo "resume playing"')
-            return
-
-        context_uri = args[0]
-        uri = len(args) > 1 and args[1] or None
-        if uri is not None:
-            if context_uri == "__liked__":
-                uris = self._get_liked_songs_uris()
-                if uris is None:
-                    return
-                uris.remove(uri)
-                uris.insert(0, uri)
-                api.play(uris)
-            else:
-                api.play(context_uri, uri)
-            return
-
-        if context_uri == "__liked__":
-            uris = self._get_liked_songs_uris()
-            api.play(uris)
+        if self.executor is None:
+            self._dispatch(lambda: self._play(api, args), self._playback_done)
         else:
-            self.nvim.command(f'echo "Playing uri: {context_uri}"')
-            api.play(context_uri)
+            self._playback().play(args)
+        self._record_command("SpotifyPlay", started)
 
     @pynvim.command("SpotifyPause")
     def pause(self):
+        started = time.perf_counter()
         api = self._check_auth()
         if api is None:
             return
-        
-        api.pause()
+
+        if self.executor is None:
+            self._dispatch(api.pause, lambda _: self._poke_now_playing())
+        else:
+            self._playback().pause()
+        self._record_command("SpotifyPause", started)
+
+    def _poke_now_playing(self):
+        if self.now_playing is not None:
+            self.now_playing.poke()
+
+    def _publish_now_playing(self, state):
+        # Runs on the poller thread, so always go through the event loop
+        self.nvim.async_call(lambda: self.nvim.exec_lua("require('spotify').setNowPlaying(...)", state))
+
+    @pynvim.function("SpotifyStartNowPlaying")
+    def start_now_playing(self, args):
+        # Called by require('spotify').nowPlaying() until the poller runs. Before
+        # :SpotifyAuth this stays silent; the poller then starts once it succeeds.
+        self.now_playing_wanted = True
+        api = self._check_auth(quiet=True)
+        if api is None:
+            return
+        self._start_now_playing(api)
+
+    def _start_now_playing(self, api: SpotifyApi):
+        if self.now_playing is None:
+            self.now_playing = NowPlayingPoller(api, self._publish_now_playing)
+        self.now_playing.start()
+        # Stops nowPlaying() from asking again
+        self.nvim.exec_lua("require('spotify').onNowPlayingStarted()")
+
+    def _fetch_playlist_tracks(self, api: SpotifyApi, id: str, on_page=None) -> list[dict]:
+        if id == "__liked__":
+            tracks = api.get_liked_songs(on_page)
+        else:
+            tracks = api.get_playlist_tracks(id, on_page)
+        return [track.to_dict() for track in tracks]
 
     @pynvim.function("SpotifyGetPlaylistTracks", sync=True)
     def get_playlist_tracks(self, args):
@@ -194,15 +389,111 @@ class SpotifyPlugin:
         if api is None:
             raise Exception("Not authenticated yet, please run :SpotifyAuth first")
 
-        id = args[0]
-        if id == "__liked__":
-            data = self._get_liked_songs()
-            if data is None:
-                return []
-            return data
+        self._note_open(args[0])
+        return self._bounded(lambda: self._fetch_playlist_tracks(api, args[0]))()
+
+    @pynvim.function("SpotifyStreamPlaylistTracks")
+    def stream_playlist_tracks(self, args):
+        # Pushes every page into the already open track picker (see
+        # require('spotify').loadPlaylistTracks) as soon as it has been fetched.
+        # The picker is always told when the stream ends, also when it failed,
+        # so it stops waiting for pages; the error itself is echoed.
+        id, stream_id = args[0], args[1]
+        started = time.perf_counter()
+        first_page = True
+
+        def push(tracks, done, failed=False):
+            nonlocal first_page
+            self.nvim.exec_lua("require('spotify').appendTracks(...)", stream_id, tracks, done, failed)
+            if first_page and not done:
+                # From the picker opening to its first page being handed over
+                first_page = False
+                self._record_command("stream_first_page", started)
 
-        data = api.get_playlist_tracks(args[0])
-        tracks = [track['track'] for track in data]
+        api = self._check_auth()
+        if api is None:
+            push([], True, True)
+            return
+        self._note_open(id)
+
+        def on_page(tracks):
+            self._post(push, [track.to_dict() for track in tracks], False)
+
+        def fetch():
+            failed = True
+            try:
+                self._fetch_playlist_tracks(api, id, on_page)
+                failed = False
+            finally:
+                self._post(push, [], True, failed)
+
+        self._dispatch(fetch)
+
+    @pynvim.command("SpotifySearch", nargs="?", complete="customlist,SpotifySearchTypes")
+    def search(self, args):
+        api = self._check_auth()
+        if api is None:
+            return
+
+        type = args[0] if len(args) > 0 else "track"
+        if type not in SEARCH_TYPES:
+            self._echo(f"Unknown search type: {type}")
+            return
+        self.nvim.exec_lua("require('spotify').showSearch(...)", type)
 
-        return tracks
+    @pynvim.function("SpotifySearchTypes", sync=True)
+    def search_types(self, args):
+        return [type for type in SEARCH_TYPES if type.startswith(args[0])]
+
+    @pynvim.function("SpotifySearchQuery")
+    def search_query(self, args):
+        # Called by the search picker after its debounce; `request_id` grows with
+        # every query, so superseded queries are skipped if they have not been
+        # sent yet and their results are dropped if they have.
+        api = self._check_auth()
+        if api is None:
+            return
+
+        query, type, request_id = args[0], args[1], args[2]
+        self.latest_search = max(self.latest_search, request_id)
+
+        def work():
+            if request_id != self.latest_search:
+                return None
+            return api.search(query, type)
+
+        def show(results):
+            if results is None or request_id != self.latest_search:
+                return
+            self.nvim.exec_lua("require('spotify').setSearchResults(...)", request_id, results)
+
+        self._dispatch(work, show)
+
+    @pynvim.function("SpotifyGetStats", sync=True)
+    def get_stats(self, args):
+        if self._get_api() is None:
+            return {}
+        return self.api.stats()
+
+    @pynvim.command("SpotifyStats", nargs="?", complete="file")
+    def show_stats(self, args):
+        # Without arguments the stats are shown in a scratch buffer; with a file
+        # name they are written there as JSON.
+        if self._get_api() is None:
+            self._echo("Please set client_id and client_secret")
+            return
+
+        stats = self.api.stats()
+        if len(args) > 0:
+            with open(os.path.expanduser(args[0]), "w") as f:
+                json.dump(stats, f, indent=2)
+            self._echo(f"Spotify stats written to {args[0]}")
+            return
 
+        self.nvim.command("new")
+        buffer = self.nvim.current.buffer
+        buffer.options["buftype"] = "nofile"
+        buffer.options["bufhidden"] = "wipe"
+        buffer.options["swapfile"] = False
+        buffer[:] = render_stats(stats)
+        buffer.options["modifiable"] = False
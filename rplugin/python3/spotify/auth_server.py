@@ -0,0 +1,103 @@
+import secrets
+import threading
+from typing import OrderedDict
+from urllib.parse import urlencode
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+from . import bottle
+
+scopes = ["user-read-playback-state", "user-modify-playback-state", "user-read-currently-playing", "playlist-read-private", "playlist-read-collaborative", "user-library-read"]
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+# Receives the OAuth redirect for :SpotifyAuth on a daemon thread of the plugin
+# host. `/` sends the browser to Spotify's consent page, `/auth` takes the code
+# back and wakes up `wait`. The socket is bound in `start`, so port 0 picks a
+# free port and a busy one fails right away.
+#
+#   server = AuthCallbackServer(client_id, accounts_base).start()
+#   open server.url in a browser
+#   code = server.wait(timeout)
+#   server.stop()
+class AuthCallbackServer:
+    host: str
+    port: int
+    code: str | None = None
+    error: str | None = None
+
+    def __init__(self, client_id: str, accounts_base: str = "https://accounts.spotify.com", host: str = "localhost", port: int = 8080):
+        self.client_id = client_id
+        self.accounts_base = accounts_base
+        self.host = host
+        self.port = port
+        self.state = secrets.token_urlsafe(16)
+        self._done = threading.Event()
+        self._stop_lock = threading.Lock()
+        self._server = None
+        self._thread: threading.Thread | None = None
+
+        self.app = bottle.Bottle()
+        self.app.route('/', 'GET', self._jump)
+        self.app.route('/auth', 'GET', self._auth)
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/"
+
+    @property
+    def redirect_uri(self) -> str:
+        return f"http://{self.host}:{self.port}/auth"
+
+    def start(self) -> "AuthCallbackServer":
+        self._server = make_server(self.host, self.port, self.app, handler_class=_QuietHandler)
+        self.port = self._server.server_port
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={"poll_interval": 0.1}, name="spotify-auth", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        # Also wakes up `wait`, which then returns None. Safe to call from any
+        # thread, more than once.
+        self._done.set()
+        with self._stop_lock:
+            if self._server is None:
+                return
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def wait(self, timeout: float | None = None) -> str | None:
+        # The authorization code, or None on timeout or `stop`. Raises if the
+        # user denied access or the redirect was invalid.
+        self._done.wait(timeout)
+        if self.error is not None:
+            raise Exception(self.error)
+        return self.code
+
+    def _jump(self):
+        q = OrderedDict(
+            response_type="code",
+            client_id=self.client_id,
+            scope=" ".join(scopes),
+            redirect_uri=self.redirect_uri,
+            state=self.state
+        )
+        bottle.redirect(f"{self.accounts_base}/authorize?{urlencode(q)}")
+
+    def _auth(self):
+        query = bottle.request.query
+        if query.get('state') != self.state:
+            # Not our redirect; keep waiting for the real one
+            return "Invalid state"
+        if 'error' in query:
+            self.error = f"Authorization failed: {query['error']}"
+            self._done.set()
+            return self.error
+        if 'code' not in query:
+            return "Missing code"
+        self.code = query['code']
+        self._done.set()
+        return "Authenticated! You can close this window."
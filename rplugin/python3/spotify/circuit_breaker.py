@@ -0,0 +1,93 @@
+import math
+import threading
+import time
+from typing import Callable
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_in: float):
+        super().__init__(f"Spotify is unreachable, not sending requests for another {max(1, math.ceil(retry_in))}s")
+        self.retry_in = retry_in
+
+# Stops sending requests after `failure_threshold` consecutive failed requests
+# (timeouts, connection errors, 5xx after retries), so commands fail at once
+# instead of each waiting for its own timeouts. After `reset_timeout` seconds
+# one request is let through as a probe: success closes the circuit again,
+# failure keeps it open for another `reset_timeout`.
+#
+# `on_change` is called with "open" or "closed" from whichever thread caused
+# the transition.
+class CircuitBreaker:
+    failure_threshold: int
+    reset_timeout: float
+    on_change: Callable[[str], None] | None = None
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._probing = False
+        self.trips = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half-open" if self._probing else "open"
+
+    def before_request(self):
+        # Raises CircuitOpenError while the circuit is open
+        with self._lock:
+            if self._opened_at is None:
+                return
+            retry_in = self._opened_at + self.reset_timeout - time.monotonic()
+            if retry_in > 0 or self._probing:
+                self.rejected += 1
+                raise CircuitOpenError(max(retry_in, 0))
+            self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            recovered = self._opened_at is not None
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+        if recovered:
+            self._notify("closed")
+
+    def release(self):
+        # The request ended without telling whether Spotify is back (e.g. its
+        # command ran out of time); let the next one probe instead
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._opened_at is not None:
+                # The probe failed; wait another reset_timeout
+                self._opened_at = time.monotonic()
+                self._probing = False
+                return
+            if self._failures < self.failure_threshold:
+                return
+            self._opened_at = time.monotonic()
+            self.trips += 1
+        self._notify("open")
+
+    def _notify(self, state: str):
+        if self.on_change is not None:
+            self.on_change(state)
+
+    def stats(self) -> dict:
+        state = self.state
+        with self._lock:
+            return {
+                "state": state,
+                "consecutive_failures": self._failures,
+                "trips": self.trips,
+                "rejected": self.rejected,
+            }
@@ -0,0 +1,55 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Per-command time budgets. A command runs its work inside `within(seconds)`,
+# and every request it makes, including retries, backoff sleeps and the pages
+# fetched on pagination threads (see `propagate`), has to finish before the
+# deadline. Nested budgets can only shorten the one already running.
+
+_local = threading.local()
+
+class DeadlineExceeded(Exception):
+    def __init__(self, message: str = "Spotify did not respond in time"):
+        super().__init__(message)
+
+def _current() -> float | None:
+    return getattr(_local, "expires_at", None)
+
+def remaining() -> float | None:
+    # Seconds left for the running command, or None without a deadline
+    expires_at = _current()
+    if expires_at is None:
+        return None
+    return expires_at - time.monotonic()
+
+def check():
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded()
+
+@contextmanager
+def _expiring_at(expires_at: float | None):
+    previous = _current()
+    if previous is not None and expires_at is not None:
+        expires_at = min(previous, expires_at)
+    elif expires_at is None:
+        expires_at = previous
+    _local.expires_at = expires_at
+    try:
+        yield
+    finally:
+        _local.expires_at = previous
+
+def within(seconds: float | None):
+    # `None` runs without a budget of its own
+    return _expiring_at(None if seconds is None else time.monotonic() + seconds)
+
+def propagate(fn):
+    # Wraps `fn` to run under the caller's deadline on another thread
+    expires_at = _current()
+
+    def run(*args, **kwargs):
+        with _expiring_at(expires_at):
+            return fn(*args, **kwargs)
+    return run
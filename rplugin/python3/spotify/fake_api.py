@@ -0,0 +1,450 @@
+import io
+import json
+import random
+import threading
+import time
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
+
+from . import bottle
+
+# A local stand-in for the parts of the Spotify Web API and accounts service
+# the plugin uses, built on the vendored bottle. It serves a synthetic library,
+# can add latency to every request and new connection, inject 429/5xx
+# responses, and counts what it served. Like Spotify, it keeps connections
+# alive and answers 401 to Web API calls whose token it did not issue or which
+# has expired. Point SpotifyApi at it with
+#   SpotifyApi(..., api_base=server.api_base, accounts_base=server.accounts_base)
+#
+#   server = FakeSpotifyServer(liked_count=5000, latency=0.05)
+#   server.start()
+#   ...
+#   server.stop()
+
+def parse_fields(fields: str) -> dict:
+    # "items(track(name,uri)),total" -> {"items": {"track": {"name": {}, "uri": {}}}, "total": {}}
+    def parse(i: int) -> tuple[dict, int]:
+        tree = {}
+        name = ""
+        while i < len(fields):
+            c = fields[i]
+            if c == "(":
+                tree[name.strip()], i = parse(i + 1)
+                name = ""
+            elif c == ")":
+                break
+            elif c == ",":
+                if name.strip():
+                    tree[name.strip()] = {}
+                name = ""
+            else:
+                name += c
+            i += 1
+        if name.strip():
+            tree[name.strip()] = {}
+        return tree, i
+
+    return parse(0)[0]
+
+def project(value, tree: dict):
+    if not tree:
+        return value
+    if isinstance(value, list):
+        return [project(item, tree) for item in value]
+    if isinstance(value, dict):
+        return { key: project(value[key], sub) for key, sub in tree.items() if key in value }
+    return value
+
+class _KeepAliveServerHandler(ServerHandler):
+    http_version = "1.1"
+
+class _KeepAliveRequestHandler(WSGIRequestHandler):
+    # wsgiref answers one HTTP/1.0 request per connection; this keeps the
+    # connection open like Spotify does, so clients can reuse it
+    protocol_version = "HTTP/1.1"
+    # Idle keep-alive connections are dropped after this many seconds
+    timeout = 30
+    # Headers and body go out in separate writes; without this the second one
+    # waits for the client's delayed ACK on every reused connection
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        # A new connection costs a round trip (the TCP handshake) before the
+        # first request; reused ones do not
+        latency = getattr(self.server, "connect_latency", None)
+        if latency is not None and latency() > 0:
+            time.sleep(latency())
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except TimeoutError:
+            self.close_connection = True
+            return
+        if not self.raw_requestline or len(self.raw_requestline) > 65536:
+            self.close_connection = True
+            return
+        if not self.parse_request():
+            return
+
+        # Read the whole body up front, so whatever the app leaves unread does
+        # not end up in front of the next request on this connection
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        handler = _KeepAliveServerHandler(io.BytesIO(body), self.wfile, self.get_stderr(), self.get_environ(), multithread=False)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+    def log_message(self, format, *args):
+        pass
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+class FakeSpotifyServer:
+    user_id: str
+    liked_count: int
+    playlist_count: int
+    playlist_size: int
+    # Tracks in every playlist but the first; defaults to playlist_size
+    other_playlist_size: int | None
+    latency: float
+    error_rate: float
+    error_status: int
+    retry_after: float
+
+    def __init__(self, liked_count: int = 200, playlist_count: int = 20, playlist_size: int = 100, latency: float = 0, error_rate: float = 0, error_status: int = 429, retry_after: float = 0, user_id: str = "fake-user", seed: int = 0, other_playlist_size: int | None = None):
+        self.user_id = user_id
+        self.liked_count = liked_count
+        self.playlist_count = playlist_count
+        self.playlist_size = playlist_size
+        self.other_playlist_size = other_playlist_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._injected: list[tuple[int, float]] = []
+        # Access tokens handed out by /api/token and when they expire; Web API
+        # calls with any other or an expired token get a 401
+        self.tokens: dict[str, float] = {}
+        self._server = None
+        self._thread = None
+        self.reset_stats()
+
+        self.liked = [{ "added_at": self._added_at(i), "track": self._track(f"liked{i}") } for i in range(liked_count)]
+        self.playlists = [self._playlist(i) for i in range(playlist_count)]
+        self.player = { "is_playing": False, "context_uri": None, "uris": None, "offset": None, "progress_ms": 0, "queue": [] }
+        self.app = self._build_app()
+
+    def _added_at(self, i: int) -> str:
+        # Newest first, one track per minute
+        return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(1700000000 - i * 60))
+
+    def _track(self, key: str) -> dict:
+        # Roughly the shape and weight of a real track object
+        return {
+            "id": key,
+            "name": f"Track {key}",
+            "uri": f"spotify:track:{key}",
+            "duration_ms": 180000 + len(key) * 1000,
+            "popularity": 50,
+            "explicit": False,
+            "available_markets": ["AD", "AE", "AR", "AT", "AU", "BE", "BG", "BR", "CA", "CH"] * 18,
+            "external_ids": { "isrc": f"FAKE{key.upper()}" },
+            "external_urls": { "spotify": f"https://open.spotify.com/track/{key}" },
+            "artists": [{ "id": f"artist-{key}", "name": f"Artist {key}", "uri": f"spotify:artist:artist-{key}" }],
+            "album": {
+                "id": f"album-{key}",
+                "name": f"Album {key}",
+                "uri": f"spotify:album:album-{key}",
+                "available_markets": ["AD", "AE", "AR", "AT", "AU", "BE", "BG", "BR", "CA", "CH"] * 18,
+                "images": [{ "url": f"https://i.scdn.co/image/{key}-{size}", "height": size, "width": size } for size in (640, 300, 64)],
+            },
+        }
+
+    def _playlist(self, i: int) -> dict:
+        id = f"playlist{i}"
+        size = self.playlist_size if i == 0 or self.other_playlist_size is None else self.other_playlist_size
+        return {
+            "id": id,
+            "name": f"Playlist {i}",
+            "uri": f"spotify:playlist:{id}",
+            "snapshot_id": f"{id}-snapshot-0",
+            "items": [{ "added_at": self._added_at(j), "track": self._track(f"{id}-{j}") } for j in range(size)],
+        }
+
+    def reset_stats(self):
+        with self._lock:
+            self.requests: dict[str, int] = {}
+            self.errors = 0
+            self.unauthorized = 0
+            self.bytes_out = 0
+        if self._server is not None:
+            self._server.connections = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": dict(self.requests),
+                "total_requests": sum(self.requests.values()),
+                "errors": self.errors,
+                "unauthorized": self.unauthorized,
+                "bytes_out": self.bytes_out,
+                "connections": self._server.connections if self._server is not None else 0,
+            }
+
+    def inject(self, status: int, count: int = 1, retry_after: float = 0):
+        # Makes the next `count` requests fail with `status`
+        with self._lock:
+            self._injected.extend([(status, retry_after)] * count)
+
+    def touch_playlist(self, index: int):
+        # Changes a playlist's snapshot_id, as editing it on Spotify would
+        playlist = self.playlists[index]
+        version = int(playlist['snapshot_id'].rsplit("-", 1)[1]) + 1
+        playlist['snapshot_id'] = f"{playlist['id']}-snapshot-{version}"
+
+    @property
+    def port(self) -> int:
+        return self._server.server_port
+
+    @property
+    def accounts_base(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def api_base(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def start(self) -> "FakeSpotifyServer":
+        adapter = bottle.WSGIRefServer(host="127.0.0.1", port=0, server_class=_ThreadingWSGIServer, handler_class=_KeepAliveRequestHandler)
+        adapter.quiet = True
+        self._thread = threading.Thread(target=adapter.run, args=(self.app,), name="fake-spotify", daemon=True)
+        self._thread.start()
+        # WSGIRefServer.run creates the server on the new thread before serving
+        while getattr(adapter, "srv", None) is None:
+            time.sleep(0.005)
+        self._server = adapter.srv
+        self._server.connect_latency = lambda: self.latency
+        return self
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _json(self, data, fields: str | None = None):
+        if fields:
+            data = project(data, parse_fields(fields))
+        body = json.dumps(data)
+        with self._lock:
+            self.bytes_out += len(body)
+        bottle.response.content_type = "application/json"
+        return body
+
+    def _page(self, items: list, fields: str | None = None):
+        offset = int(bottle.request.query.get("offset", 0))
+        limit = int(bottle.request.query.get("limit", 20))
+        page = {
+            "items": items[offset:offset + limit],
+            "total": len(items),
+            "offset": offset,
+            "limit": limit,
+            "next": None if offset + limit >= len(items) else f"offset={offset + limit}",
+        }
+        return self._json(page, fields)
+
+    def _authorized(self) -> bool:
+        # Must be called with the lock held
+        header = bottle.request.get_header("Authorization", "")
+        expires_at = self.tokens.get(header.removeprefix("Bearer "))
+        return expires_at is not None and expires_at > time.time()
+
+    def _before_request(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self._lock:
+            route = bottle.request.route.rule
+            self.requests[route] = self.requests.get(route, 0) + 1
+            if route.startswith("/v1/") and not self._authorized():
+                self.unauthorized += 1
+                body = json.dumps({ "error": { "status": 401, "message": "The access token expired" } })
+                raise bottle.HTTPResponse(body, 401, content_type="application/json")
+            injected = self._injected.pop(0) if self._injected else None
+            if injected is None and self.error_rate > 0 and self._random.random() < self.error_rate:
+                injected = (self.error_status, self.retry_after)
+            if injected is not None:
+                self.errors += 1
+        if injected is not None:
+            status, retry_after = injected
+            headers = { "Retry-After": str(retry_after) } if status == 429 else {}
+            body = json.dumps({ "error": { "status": status, "message": "injected error" } })
+            raise bottle.HTTPResponse(body, status, headers, content_type="application/json")
+
+    def _build_app(self) -> bottle.Bottle:
+        app = bottle.Bottle()
+
+        def route(rule, method="GET"):
+            def decorator(fn):
+                def handler(*args, **kwargs):
+                    self._before_request()
+                    return fn(*args, **kwargs)
+                app.route(rule, method, handler)
+                return fn
+            return decorator
+
+        @route("/api/token", "POST")
+        def token():
+            grant_type = bottle.request.forms.get("grant_type")
+            data = { "access_token": f"fake-access-{time.time()}", "token_type": "Bearer", "expires_in": 3600, "scope": "" }
+            with self._lock:
+                self.tokens[data["access_token"]] = time.time() + data["expires_in"]
+            if grant_type == "authorization_code":
+                data["refresh_token"] = "fake-refresh"
+            return self._json(data)
+
+        @route("/v1/me")
+        def me():
+            return self._json({ "id": self.user_id, "display_name": "Fake User" })
+
+        @route("/v1/me/tracks")
+        def liked():
+            return self._page(self.liked)
+
+        @route("/v1/users/<user_id>/playlists")
+        def playlists(user_id):
+            items = [{ key: value for key, value in playlist.items() if key != "items" } for playlist in self.playlists]
+            return self._page(items)
+
+        def find_playlist(playlist_id):
+            for playlist in self.playlists:
+                if playlist['id'] == playlist_id:
+                    return playlist
+            raise bottle.HTTPResponse(json.dumps({ "error": { "status": 404, "message": "Not found." } }), 404, content_type="application/json")
+
+        @route("/v1/playlists/<playlist_id>")
+        def playlist(playlist_id):
+            data = find_playlist(playlist_id)
+            return self._json({ key: value for key, value in data.items() if key != "items" }, bottle.request.query.get("fields"))
+
+        @route("/v1/playlists/<playlist_id>/tracks")
+        def playlist_tracks(playlist_id):
+            return self._page(find_playlist(playlist_id)['items'], bottle.request.query.get("fields"))
+
+        @route("/v1/search")
+        def search():
+            # Only tracks are searchable; other types come back empty
+            query = bottle.request.query.get("q", "").lower()
+            type = bottle.request.query.get("type", "track")
+            limit = int(bottle.request.query.get("limit", 20))
+            items = []
+            if type == "track":
+                tracks = [item["track"] for item in self.liked]
+                for playlist in self.playlists:
+                    tracks += [item["track"] for item in playlist["items"]]
+                items = [track for track in tracks if query in track["name"].lower()][:limit]
+            return self._json({ f"{type}s": { "items": items, "total": len(items), "limit": limit, "offset": 0 } })
+
+        @route("/v1/me/player/play", "PUT")
+        def play():
+            body = bottle.request.json or {}
+            self.player.update(is_playing=True, context_uri=body.get("context_uri"), uris=body.get("uris"), offset=body.get("offset"))
+            bottle.response.status = 204
+
+        @route("/v1/me/player/pause", "PUT")
+        def pause():
+            self.player["is_playing"] = False
+            bottle.response.status = 204
+
+        @route("/v1/me/player/queue", "POST")
+        def queue():
+            self.player["queue"].append(bottle.request.query.get("uri"))
+            bottle.response.status = 204
+
+        @route("/v1/me/player/currently-playing")
+        def currently_playing():
+            if self.player["context_uri"] is None and not self.player["uris"]:
+                bottle.response.status = 204
+                return
+            item = self.liked[0]["track"] if self.liked else self._track("now")
+            return self._json({
+                "is_playing": self.player["is_playing"],
+                "progress_ms": self.player["progress_ms"],
+                "timestamp": int(time.time() * 1000),
+                "context": { "uri": self.player["context_uri"] },
+                "item": item,
+            })
+
+        # Lets a process running the stand-in (see `main`) be driven remotely.
+        # Not counted in the stats and not subject to latency or errors.
+        @app.route("/_control/stats")
+        def control_stats():
+            return self.stats()
+
+        @app.route("/_control/reset", "POST")
+        def control_reset():
+            self.reset_stats()
+
+        @app.route("/_control/latency", "POST")
+        def control_latency():
+            self.latency = float(bottle.request.query.get("value"))
+
+        @app.route("/_control/inject", "POST")
+        def control_inject():
+            query = bottle.request.query
+            self.inject(int(query.get("status")), int(query.get("count", 1)), float(query.get("retry_after", 0)))
+
+        @app.route("/_control/library")
+        def control_library():
+            return { "playlist_ids": [playlist["id"] for playlist in self.playlists], "liked_count": len(self.liked) }
+
+        @app.route("/_control/liked/<index:int>")
+        def control_liked(index):
+            return self.liked[index]
+
+        return app
+
+def main():
+    # Runs the stand-in in its own process, e.g. so that a benchmark's memory
+    # figures do not include the synthetic library:
+    #   python -m spotify.fake_api --liked-count 20000
+    # Prints the port once it is listening and serves until stdin is closed.
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Local stand-in for the Spotify Web API")
+    parser.add_argument("--liked-count", type=int, default=200)
+    parser.add_argument("--playlist-count", type=int, default=20)
+    parser.add_argument("--playlist-size", type=int, default=100)
+    parser.add_argument("--other-playlist-size", type=int, help="tracks in every playlist but the first")
+    parser.add_argument("--latency", type=float, default=0)
+    args = parser.parse_args()
+
+    server = FakeSpotifyServer(liked_count=args.liked_count, playlist_count=args.playlist_count, playlist_size=args.playlist_size, other_playlist_size=args.other_playlist_size, latency=args.latency).start()
+    print(server.port, flush=True)
+    try:
+        sys.stdin.read()
+    finally:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import json
+import sqlite3
+import threading
+import time
+
+# Bump when the table layout changes; it is only a cache, so old tables are dropped.
+SCHEMA_VERSION = 3
+
+class LibraryCache:
+    path: str
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            self._conn.executescript("""
+                DROP TABLE IF EXISTS playlists;
+                DROP TABLE IF EXISTS playlist_tracks;
+                DROP TABLE IF EXISTS liked_tracks;
+                DROP TABLE IF EXISTS playlist_opens;
+            """)
+            self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS playlists (
+                id TEXT PRIMARY KEY,
+                position INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                uri TEXT NOT NULL,
+                snapshot_id TEXT,
+                listed_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS playlist_tracks (
+                playlist_id TEXT PRIMARY KEY,
+                snapshot_id TEXT NOT NULL,
+                fields TEXT NOT NULL,
+                tracks TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS liked_tracks (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                fields TEXT NOT NULL,
+                items TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS playlist_opens (
+                playlist_id TEXT PRIMARY KEY,
+                count INTEGER NOT NULL
+            );
+        """)
+        self._conn.commit()
+
+    def save_playlists(self, playlists: list[dict]):
+        # Replaces the playlist list and drops tracks of playlists that are gone.
+        now = time.time()
+        with self._lock:
+            self._conn.execute("DELETE FROM playlists")
+            self._conn.executemany(
+                "INSERT INTO playlists (id, position, name, uri, snapshot_id, listed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(p['id'], i, p['name'], p['uri'], p.get('snapshot_id'), now) for i, p in enumerate(playlists)]
+            )
+            self._conn.execute("DELETE FROM playlist_tracks WHERE playlist_id NOT IN (SELECT id FROM playlists)")
+            self._conn.commit()
+
+    def get_snapshot_id(self, playlist_id: str, max_age: float) -> str | None:
+        # The snapshot id the playlist list reported, if it was fetched within
+        # the last `max_age` seconds
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT snapshot_id FROM playlists WHERE id = ? AND listed_at >= ?",
+                (playlist_id, time.time() - max_age)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get_tracks(self, playlist_id: str, snapshot_id: str, fields: str) -> list | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT tracks FROM playlist_tracks WHERE playlist_id = ? AND snapshot_id = ? AND fields = ?",
+                (playlist_id, snapshot_id, fields)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def save_tracks(self, playlist_id: str, snapshot_id: str, fields: str, tracks: list):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO playlist_tracks (playlist_id, snapshot_id, fields, tracks) VALUES (?, ?, ?, ?)",
+                (playlist_id, snapshot_id, fields, json.dumps(tracks))
+            )
+            self._conn.commit()
+
+    def get_liked_items(self, fields: str) -> list | None:
+        with self._lock:
+            row = self._conn.execute("SELECT items FROM liked_tracks WHERE id = 0 AND fields = ?", (fields,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def save_liked_items(self, fields: str, items: list):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO liked_tracks (id, fields, items) VALUES (0, ?, ?)", (fields, json.dumps(items)))
+            self._conn.commit()
+
+    def record_open(self, playlist_id: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO playlist_opens (playlist_id, count) VALUES (?, 1) ON CONFLICT (playlist_id) DO UPDATE SET count = count + 1",
+                (playlist_id,)
+            )
+            self._conn.commit()
+
+    def most_opened(self, limit: int) -> list[str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT playlist_id FROM playlist_opens ORDER BY count DESC LIMIT ?", (limit,)).fetchall()
+        return [row[0] for row in rows]
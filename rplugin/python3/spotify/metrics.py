@@ -0,0 +1,212 @@
+import math
+import random
+import threading
+
+# Upper bounds (ms) of the latency histogram buckets; the last bucket is unbounded
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Latencies kept per endpoint or command for the percentiles; beyond that a
+# uniform random sample of all of them is kept (reservoir sampling)
+LATENCY_SAMPLES = 1000
+
+class EndpointMetrics:
+    __slots__ = ("requests", "errors", "retries", "throttled", "throttled_time", "bytes_in", "bytes_out", "latency_buckets", "latency_sum", "latency_max", "latency_count", "latency_samples")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors: dict[int | str, int] = {}
+        self.retries = 0
+        self.throttled = 0
+        self.throttled_time = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.latency_count = 0
+        self.latency_samples: list[float] = []
+
+    def observe(self, elapsed_ms: float):
+        self.latency_sum += elapsed_ms
+        self.latency_max = max(self.latency_max, elapsed_ms)
+        self.latency_count += 1
+        if len(self.latency_samples) < LATENCY_SAMPLES:
+            self.latency_samples.append(elapsed_ms)
+        else:
+            slot = random.randrange(self.latency_count)
+            if slot < LATENCY_SAMPLES:
+                self.latency_samples[slot] = elapsed_ms
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                self.latency_buckets[i] += 1
+                break
+        else:
+            self.latency_buckets[-1] += 1
+
+    def percentile(self, p: float) -> float | None:
+        # Nearest-rank percentile of the sampled latencies; exact up to
+        # LATENCY_SAMPLES observations. The buckets are too coarse for this.
+        if not self.latency_samples:
+            return None
+        ordered = sorted(self.latency_samples)
+        index = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+        return round(ordered[index], 3)
+
+    def to_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": { str(status): count for status, count in self.errors.items() },
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "throttled_time": round(self.throttled_time, 3),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "latency_ms": {
+                "buckets": dict(zip([str(bound) for bound in LATENCY_BUCKETS_MS] + ["inf"], self.latency_buckets)),
+                "mean": round(self.latency_sum / self.requests, 3) if self.requests else None,
+                "p50": self.percentile(50),
+                "p95": self.percentile(95),
+                "max": round(self.latency_max, 3),
+            },
+        }
+
+# Counters collected by SpotifyApi and shown by :SpotifyStats. All methods
+# are safe to call from the pagination and job threads.
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.endpoints: dict[str, EndpointMetrics] = {}
+            self.cache: dict[str, dict[str, int]] = {}
+            self.token_refreshes = 0
+            self.token_adoptions = 0
+            self.counters: dict[str, float] = {}
+            # Plugin-side latencies, e.g. from a keymap to the command returning
+            self.commands: dict[str, EndpointMetrics] = {}
+
+    def _endpoint(self, endpoint: str) -> EndpointMetrics:
+        metrics = self.endpoints.get(endpoint)
+        if metrics is None:
+            metrics = EndpointMetrics()
+            self.endpoints[endpoint] = metrics
+        return metrics
+
+    def record_request(self, endpoint: str, status: int, elapsed_ms: float, bytes_in: int, bytes_out: int):
+        with self._lock:
+            metrics = self._endpoint(endpoint)
+            metrics.requests += 1
+            if status >= 400:
+                metrics.errors[status] = metrics.errors.get(status, 0) + 1
+            metrics.bytes_in += bytes_in
+            metrics.bytes_out += bytes_out
+            metrics.observe(elapsed_ms)
+
+    def record_transport_error(self, endpoint: str, kind: str, elapsed_ms: float):
+        # A request that got no response; `kind` is "timeout" or "connection"
+        with self._lock:
+            metrics = self._endpoint(endpoint)
+            metrics.requests += 1
+            metrics.errors[kind] = metrics.errors.get(kind, 0) + 1
+            metrics.observe(elapsed_ms)
+
+    def record_retry(self, endpoint: str, delay: float, throttled: bool):
+        with self._lock:
+            metrics = self._endpoint(endpoint)
+            metrics.retries += 1
+            metrics.throttled_time += delay
+            if throttled:
+                metrics.throttled += 1
+
+    def record_wait(self, endpoint: str, delay: float):
+        # Time spent waiting for the rate-limit budget before sending
+        with self._lock:
+            self._endpoint(endpoint).throttled_time += delay
+
+    def record_cache(self, name: str, result: str):
+        # `result` is "hit", "miss", or any finer-grained outcome the caller uses
+        with self._lock:
+            counters = self.cache.setdefault(name, {})
+            counters[result] = counters.get(result, 0) + 1
+
+    def add(self, name: str, value: float = 1):
+        # Free-form counters, e.g. for prefetching
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_command(self, name: str, elapsed_ms: float):
+        with self._lock:
+            metrics = self.commands.get(name)
+            if metrics is None:
+                metrics = EndpointMetrics()
+                self.commands[name] = metrics
+            metrics.requests += 1
+            metrics.observe(elapsed_ms)
+
+    def record_token_refresh(self, adopted: bool = False):
+        with self._lock:
+            if adopted:
+                self.token_adoptions += 1
+            else:
+                self.token_refreshes += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "endpoints": { name: metrics.to_dict() for name, metrics in sorted(self.endpoints.items()) },
+                "cache": { name: dict(counters) for name, counters in sorted(self.cache.items()) },
+                "token_refreshes": self.token_refreshes,
+                "token_adoptions": self.token_adoptions,
+                "counters": dict(sorted(self.counters.items())),
+                "commands": { name: {
+                    "calls": metrics.requests,
+                    "mean_ms": round(metrics.latency_sum / metrics.requests, 3),
+                    "p50_ms": metrics.percentile(50),
+                    "p95_ms": metrics.percentile(95),
+                    "max_ms": round(metrics.latency_max, 3),
+                } for name, metrics in sorted(self.commands.items()) },
+            }
+
+def format_bytes(count: int) -> str:
+    for unit in ("B", "KB", "MB"):
+        if count < 1024:
+            return f"{count:.0f}{unit}" if unit == "B" else f"{count:.1f}{unit}"
+        count /= 1024
+    return f"{count:.1f}GB"
+
+def render_stats(stats: dict) -> list[str]:
+    # Plain-text table of a stats snapshot for the :SpotifyStats buffer
+    lines = ["Spotify API", ""]
+    header = f"{'endpoint':<16} {'reqs':>6} {'errors':>7} {'retries':>7} {'p50':>7} {'p95':>7} {'max':>8} {'throttled':>10} {'in':>9} {'out':>9}"
+    lines.append(header)
+    lines.append("-" * len(header))
+    for name, metrics in stats["endpoints"].items():
+        latency = metrics["latency_ms"]
+        errors = sum(metrics["errors"].values())
+        p50 = "-" if latency["p50"] is None else f"{latency['p50']:.0f}ms"
+        p95 = "-" if latency["p95"] is None else f"{latency['p95']:.0f}ms"
+        lines.append(
+            f"{name:<16} {metrics['requests']:>6} {errors:>7} {metrics['retries']:>7} {p50:>7} {p95:>7} {latency['max']:>6.0f}ms"
+            f" {metrics['throttled_time']:>9.1f}s {format_bytes(metrics['bytes_in']):>9} {format_bytes(metrics['bytes_out']):>9}"
+        )
+
+    lines += ["", f"Token refreshes: {stats['token_refreshes']} (adopted from other instances: {stats['token_adoptions']})"]
+    if stats["cache"]:
+        lines += ["", "Cache"]
+        for name, counters in stats["cache"].items():
+            lines.append(f"  {name:<16} " + "  ".join(f"{result}={count}" for result, count in sorted(counters.items())))
+    if stats.get("commands"):
+        # Keymap-to-return latencies are well under a millisecond
+        lines += ["", f"{'command':<24} {'calls':>6} {'p50':>11} {'p95':>11} {'max':>11}"]
+        for name, latency in stats["commands"].items():
+            lines.append(f"{name:<24} {latency['calls']:>6} {latency['p50_ms']:>9.3f}ms {latency['p95_ms']:>9.3f}ms {latency['max_ms']:>9.3f}ms")
+    for key, value in stats.items():
+        if key in ("endpoints", "cache", "token_refreshes", "token_adoptions", "commands"):
+            continue
+        if isinstance(value, dict):
+            lines += ["", key] + [f"  {k}: {v}" for k, v in value.items()]
+        else:
+            lines.append(f"{key}: {value}")
+    return lines
@@ -0,0 +1,72 @@
+import threading
+import time
+
+# Polls /me/player/currently-playing on a background thread and hands every
+# changed state to `publish`. The statusline never waits on it: the Lua side
+# keeps the last state and extrapolates the progress locally between polls.
+#
+# The interval adapts to what is playing: just after the current track should
+# end (to pick up the next one quickly), `playing_interval` while playing
+# (to notice skips and seeks from other devices), and slower while paused or idle.
+class NowPlayingPoller:
+    playing_interval: float
+    paused_interval: float
+    idle_interval: float
+    boundary_delay: float
+
+    def __init__(self, api, publish, playing_interval: float = 15, paused_interval: float = 30, idle_interval: float = 60, boundary_delay: float = 1):
+        self.api = api
+        self.publish = publish
+        self.playing_interval = playing_interval
+        self.paused_interval = paused_interval
+        self.idle_interval = idle_interval
+        self.boundary_delay = boundary_delay
+        self.state: dict | None = None
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread: threading.Thread | None = None
+        self._next_poll = 0.0
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="spotify-now-playing", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def poke(self, delay: float = 1):
+        # Polls again soon, e.g. after a playback command (the player needs a
+        # moment before the new state is visible)
+        self._next_poll = min(self._next_poll, time.monotonic() + delay)
+        self._wake.set()
+
+    def _interval(self, state: dict | None) -> float:
+        if state is None:
+            return self.idle_interval
+        if not state['is_playing']:
+            return self.paused_interval
+        remaining = (state['duration_ms'] - state['progress_ms']) / 1000
+        return max(0.5, min(self.playing_interval, remaining + self.boundary_delay))
+
+    def _run(self):
+        while not self._stopped:
+            delay = self._next_poll - time.monotonic()
+            if delay > 0:
+                self._wake.wait(delay)
+                self._wake.clear()
+                continue
+
+            try:
+                state = self.api.get_currently_playing()
+            except Exception:
+                self._next_poll = time.monotonic() + self.idle_interval
+                continue
+
+            self._next_poll = time.monotonic() + self._interval(state)
+            if state != self.state:
+                self.state = state
+                self.publish(state)
@@ -0,0 +1,127 @@
+import threading
+import time
+
+from . import deadline
+from .metrics import Metrics
+
+# Applies playback commands on one worker thread, in the order they were issued,
+# so :SpotifyPlay / :SpotifyPause return to the editor at once and a mashed
+# keymap cannot reorder them.
+#
+# Commands still waiting are coalesced: consecutive play/pause commands collapse
+# into the state they end in (play X, pause, play -> play X), and consecutive
+# queue adds are sent as one batch. A command is never merged across a queue
+# add, which keeps "play, queue, pause" meaning what it says.
+#
+# `play`, `pause` and `add_to_queue` do the actual requests; `on_done` gets the
+# message returned by `play`, `on_error` every failure. Both run on the worker.
+class PlaybackDispatcher:
+    timeout: float
+
+    def __init__(self, play, pause, add_to_queue, on_done=None, on_error=None, metrics: Metrics | None = None, timeout: float = 30):
+        self._play = play
+        self._pause = pause
+        self._add_to_queue = add_to_queue
+        self.on_done = on_done
+        self.on_error = on_error
+        self.metrics = metrics or Metrics()
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._pending: list[dict] = []
+        self._thread: threading.Thread | None = None
+        self._stopped = False
+
+    def _start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="spotify-playback", daemon=True)
+        self._thread.start()
+
+    def _enqueue(self, kind: str, update):
+        # `update` turns the last pending command of the same kind (or a fresh
+        # one) into the coalesced command
+        with self._cond:
+            tail = self._pending[-1] if self._pending else None
+            if tail is not None and tail["kind"] == kind:
+                self.metrics.add("playback_coalesced")
+            else:
+                tail = { "kind": kind }
+                self._pending.append(tail)
+            update(tail)
+            tail["issued_at"] = time.perf_counter()
+            self._cond.notify()
+        self._start()
+
+    def play(self, args: list[str]):
+        def update(command):
+            if len(args) > 0:
+                command["play_args"] = args
+            command["playing"] = True
+        self._enqueue("state", update)
+
+    def pause(self):
+        def update(command):
+            command["playing"] = False
+        self._enqueue("state", update)
+
+    def add_to_queue(self, uri: str):
+        self._enqueue("queue", lambda command: command.setdefault("uris", []).append(uri))
+
+    def stop(self, timeout: float | None = None):
+        # Applies what is still pending, then ends the worker
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                command = self._pending.pop(0)
+
+            try:
+                with deadline.within(self.timeout):
+                    message = self._apply(command)
+            except Exception as e:
+                if self.on_error is not None:
+                    self.on_error(e)
+            else:
+                if self.on_done is not None:
+                    self.on_done(message)
+            # From the last coalesced keypress to the player being updated
+            self.metrics.record_command("playback_applied", (time.perf_counter() - command["issued_at"]) * 1000)
+
+    def _apply(self, command: dict) -> str | None:
+        if command["kind"] == "queue":
+            return self._apply_queue(command["uris"])
+
+        play_args = command.get("play_args")
+        if play_args is not None:
+            message = self._play(play_args)
+            if not command["playing"]:
+                self._pause()
+            return message
+        if command["playing"]:
+            return self._play([])
+        self._pause()
+        return None
+
+    def _apply_queue(self, uris: list[str]) -> str | None:
+        failed = []
+        for uri in uris:
+            try:
+                self._add_to_queue(uri)
+            except Exception as e:
+                failed.append(e)
+        if failed:
+            raise Exception(f"Could not queue {len(failed)} of {len(uris)} tracks: {failed[0]}")
+        return f"Queued {len(uris)} tracks" if len(uris) > 1 else "Queued"
@@ -0,0 +1,124 @@
+import threading
+
+# Warms the library cache with the tracks of playlists the user is likely to
+# open from the playlist picker, so <C-d> usually finds them cached.
+#
+# A session starts when the picker opens: the most-opened playlists and the
+# first entries are queued. Moving the selection replaces the queue with the
+# highlighted playlist and its neighbours. Work runs on one low-priority thread
+# (see the "prefetch" budget in SpotifyApi) and stops once the session has
+# downloaded `budget_bytes`.
+#
+# Metrics: prefetch_hits / prefetch_misses count opened playlists that were or
+# were not prefetched (or found already cached) in the session, prefetch_bytes what prefetching
+# downloaded, and prefetch_wasted_bytes the part of it that was never opened.
+class PlaylistPrefetcher:
+    neighbours: int
+    top_opened: int
+    budget_bytes: int
+
+    def __init__(self, api, neighbours: int = 2, top_opened: int = 3, budget_bytes: int = 4 * 1024 * 1024):
+        self.api = api
+        self.neighbours = neighbours
+        self.top_opened = top_opened
+        self.budget_bytes = budget_bytes
+        self._cond = threading.Condition()
+        self._queue: list[str] = []
+        self._playlist_ids: list[str] = []
+        # Playlists prefetched in this session and the bytes they cost
+        self._prefetched: dict[str, int] = {}
+        # The playlist being prefetched right now, and whether it was opened
+        # meanwhile; `_run` settles it once the fetch ends
+        self._inflight: str | None = None
+        self._inflight_opened = False
+        self._session_bytes = 0
+        self._thread: threading.Thread | None = None
+
+    def _start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="spotify-prefetch", daemon=True)
+        self._thread.start()
+
+    def _settle(self):
+        # Whatever was prefetched but not opened by now is counted as wasted
+        wasted = sum(self._prefetched.values())
+        if wasted:
+            self.api.metrics.add("prefetch_wasted_bytes", wasted)
+        self._prefetched = {}
+        self._session_bytes = 0
+
+    def start_session(self, playlist_ids: list[str]):
+        with self._cond:
+            self._settle()
+            self._playlist_ids = [id for id in playlist_ids if id != "__liked__"]
+            known = set(self._playlist_ids)
+            queue = [id for id in self.api.library.most_opened(self.top_opened) if id in known]
+            queue += [id for id in self._playlist_ids[:self.neighbours + 1] if id not in queue]
+            self._queue = queue
+            self._cond.notify()
+        self._start()
+
+    def focus(self, playlist_id: str):
+        with self._cond:
+            if playlist_id not in self._playlist_ids:
+                return
+            index = self._playlist_ids.index(playlist_id)
+            queue = [playlist_id]
+            for distance in range(1, self.neighbours + 1):
+                for neighbour in (index + distance, index - distance):
+                    if 0 <= neighbour < len(self._playlist_ids):
+                        queue.append(self._playlist_ids[neighbour])
+            self._queue = [id for id in queue if id not in self._prefetched]
+            self._cond.notify()
+        self._start()
+
+    def note_open(self, playlist_id: str):
+        self.api.library.record_open(playlist_id)
+        if playlist_id == "__liked__":
+            return
+        with self._cond:
+            if playlist_id in self._queue:
+                self._queue.remove(playlist_id)
+            if playlist_id == self._inflight:
+                self._inflight_opened = True
+                return
+            hit = self._prefetched.pop(playlist_id, None) is not None
+        self.api.metrics.add("prefetch_hits" if hit else "prefetch_misses")
+
+    def _bytes_in(self) -> int:
+        return self.api.metrics.snapshot()["endpoints"].get("prefetch", {}).get("bytes_in", 0)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue or self._session_bytes >= self.budget_bytes:
+                    self._cond.wait()
+                playlist_id = self._queue.pop(0)
+                if playlist_id in self._prefetched:
+                    continue
+                self._inflight = playlist_id
+                self._inflight_opened = False
+
+            before = self._bytes_in()
+            try:
+                fetched = self.api.prefetch_playlist_tracks(playlist_id)
+            except Exception:
+                fetched = None
+            cost = self._bytes_in() - before
+            self.api.metrics.add("prefetch_bytes", cost)
+
+            with self._cond:
+                self._inflight = None
+                opened = self._inflight_opened
+                self._session_bytes += cost
+                if fetched is not None and not opened:
+                    # A playlist that was already cached is just as ready to open;
+                    # none of its tracks were downloaded, so nothing can be wasted
+                    self._prefetched[playlist_id] = cost if fetched else 0
+            if opened:
+                # Opened while in flight: the open shares the prefetch's page
+                # requests, so it is a hit unless the prefetch failed
+                self.api.metrics.add("prefetch_hits" if fetched is not None else "prefetch_misses")
+            elif fetched is None:
+                self.api.metrics.add("prefetch_wasted_bytes", cost)
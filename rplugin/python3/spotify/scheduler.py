@@ -0,0 +1,166 @@
+import random
+import threading
+import time
+
+import requests
+
+from . import deadline
+from .circuit_breaker import CircuitBreaker
+from .deadline import DeadlineExceeded
+from .metrics import Metrics
+
+# A 5xx can come back for a request Spotify did apply, so it is only retried
+# for methods that do the same when sent twice; POST /me/player/queue would
+# queue the track again. A 429 was never applied and is retried for all.
+RETRY_5XX_METHODS = ("GET", "PUT")
+
+class TokenBucket:
+    rate: float
+    capacity: float
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def reserve(self) -> float:
+        # Takes one token and returns how long the caller has to wait for it.
+        # Must be called with the scheduler lock held.
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0
+        return -self._tokens / self.rate
+
+# Every HTTP call to Spotify goes through here. Requests are paced by a token
+# bucket per endpoint, capped by a global concurrency limit, and 429 responses
+# (and 5xx ones for GET and PUT) are retried after `Retry-After` or a jittered
+# exponential backoff.
+# A 429 pauses all endpoints, since Spotify's rate limit applies to the whole app.
+#
+# Every request has a connect and read `timeout`, and none outlives the deadline
+# of the running command (see deadline.py): waits and retries that would end
+# after it raise DeadlineExceeded right away. Timeouts and connection errors are
+# retried for GETs only. Requests that still fail feed the circuit breaker.
+class RequestScheduler:
+    default_budget: tuple[float, float]
+    budgets: dict[str, tuple[float, float]]
+    max_retries: int
+    backoff_base: float
+    backoff_max: float
+    timeout: tuple[float, float]
+    metrics: Metrics
+    breaker: CircuitBreaker
+
+    def __init__(self, max_concurrency: int = 8, default_budget: tuple[float, float] = (20, 50), budgets: dict[str, tuple[float, float]] | None = None, max_retries: int = 4, backoff_base: float = 0.5, backoff_max: float = 30, timeout: tuple[float, float] = (3.05, 10), metrics: Metrics | None = None, breaker: CircuitBreaker | None = None):
+        self.default_budget = default_budget
+        self.budgets = budgets or {}
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.metrics = metrics or Metrics()
+        self.breaker = breaker or CircuitBreaker()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._buckets: dict[str, TokenBucket] = {}
+        self._blocked_until = 0.0
+
+    def _wait_for_budget(self, endpoint: str):
+        with self._lock:
+            bucket = self._buckets.get(endpoint)
+            if bucket is None:
+                bucket = TokenBucket(*self.budgets.get(endpoint, self.default_budget))
+                self._buckets[endpoint] = bucket
+            delay = max(bucket.reserve(), self._blocked_until - time.monotonic())
+        if delay > 0:
+            self._sleep(delay)
+            self.metrics.record_wait(endpoint, delay)
+
+    def _sleep(self, delay: float):
+        left = deadline.remaining()
+        if left is not None and delay >= left:
+            raise DeadlineExceeded()
+        time.sleep(delay)
+
+    def _timeout(self) -> tuple[tuple[float, float], bool]:
+        # The (connect, read) timeout for the next attempt, and whether the
+        # command deadline shortened it
+        connect, read = self.timeout
+        left = deadline.remaining()
+        if left is None or left >= max(connect, read):
+            return (connect, read), False
+        if left <= 0:
+            raise DeadlineExceeded()
+        return (min(connect, left), min(read, left)), True
+
+    def _retry_delay(self, res: requests.Response | None, attempt: int) -> float:
+        retry_after = res.headers.get("Retry-After") if res is not None else None
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        backoff = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return random.uniform(backoff / 2, backoff)
+
+    def request(self, session: requests.Session, endpoint: str, method: str, url: str, **kwargs) -> requests.Response:
+        # The breaker sees one outcome per request, after its retries
+        self.breaker.before_request()
+        try:
+            res = self._request_with_retries(session, endpoint, method, url, **kwargs)
+        except (requests.Timeout, requests.ConnectionError):
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            # Out of time (or interrupted) before the server could answer
+            self.breaker.release()
+            raise
+        if res.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return res
+
+    def _request_with_retries(self, session: requests.Session, endpoint: str, method: str, url: str, **kwargs) -> requests.Response:
+        attempt = 0
+        while True:
+            deadline.check()
+            self._wait_for_budget(endpoint)
+            with self._slots:
+                timeout, capped = self._timeout()
+                started = time.perf_counter()
+                try:
+                    res = session.request(method, url, timeout=timeout, **kwargs)
+                except (requests.Timeout, requests.ConnectionError) as e:
+                    elapsed_ms = (time.perf_counter() - started) * 1000
+                    timed_out = isinstance(e, requests.Timeout)
+                    self.metrics.record_transport_error(endpoint, "timeout" if timed_out else "connection", elapsed_ms)
+                    if timed_out and capped:
+                        raise DeadlineExceeded() from e
+                    if method != "GET" or attempt >= self.max_retries:
+                        raise
+                    res = None
+                elapsed_ms = (time.perf_counter() - started) * 1000
+
+            if res is not None:
+                body = res.request.body if res.request is not None else None
+                self.metrics.record_request(endpoint, res.status_code, elapsed_ms, len(res.content or b""), len(body) if body else 0)
+                if res.status_code != 429 and res.status_code < 500:
+                    return res
+                if attempt >= self.max_retries:
+                    return res
+                if res.status_code != 429 and method not in RETRY_5XX_METHODS:
+                    return res
+
+            delay = self._retry_delay(res, attempt)
+            attempt += 1
+            throttled = res is not None and res.status_code == 429
+            if throttled:
+                with self._lock:
+                    self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+            self.metrics.record_retry(endpoint, delay, throttled)
+            self._sleep(delay)
@@ -0,0 +1,36 @@
+import threading
+import time
+from collections import OrderedDict
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+# Least-recently-used cache whose entries also expire after `ttl` seconds
+class SearchCache:
+    capacity: int
+    ttl: float
+
+    def __init__(self, capacity: int = 256, ttl: float = 600):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
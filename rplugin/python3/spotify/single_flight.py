@@ -0,0 +1,48 @@
+import threading
+from concurrent.futures import Future
+
+# Shares one in-flight call among every caller asking for the same key. The
+# first caller runs the function, later callers wait for its result (or error).
+class SingleFlight:
+    calls: int = 0
+    coalesced: int = 0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: dict = {}
+
+    def do(self, key, fn, timeout: float | None = None):
+        # `timeout` bounds how long a follower waits for the leader
+        # (concurrent.futures.TimeoutError)
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                self.calls += 1
+                future = Future()
+                self._inflight[key] = future
+                leader = True
+
+        if not leader:
+            return future.result(max(timeout, 0) if timeout is not None else None)
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+            }
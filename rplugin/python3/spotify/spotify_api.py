@@ -1,9 +1,37 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from functools import cache
+from typing import Callable
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import os
 import time
 import math
+import threading
+
+from . import deadline
+from .circuit_breaker import CircuitBreaker
+from .deadline import DeadlineExceeded
+from .file_lock import FileLock
+from .library_cache import LibraryCache
+from .metrics import Metrics
+from .scheduler import RequestScheduler
+from .search_cache import SearchCache, normalize_query
+from .single_flight import SingleFlight
+from .token_refresher import TokenRefresher
+from .track import Track, parse_columns
+
+# Seconds the snapshot ids from the playlist list are trusted, so opening a
+# playlist from the picker needs no snapshot request of its own. A change made
+# elsewhere in that window shows up on the next open after it.
+SNAPSHOT_MAX_AGE = 60
+
+class SpotifyApiError(Exception):
+    status_code: int
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f"Spotify API error {status_code}: {message}")
+        self.status_code = status_code
 
 class SpotifyApi:
     client_id: str
@@ -16,9 +44,82 @@ class SpotifyApi:
     expires_at: int | None = None
     refresh_token: str | None = None
 
-    def __init__(self, client_id, client_secret):
+    # Point these at a local stand-in (see fake_api.py) for tests and benchmarks
+    api_base: str
+    accounts_base: str
+    session: requests.Session
+    max_concurrency: int
+    # Track fields requested from /playlists/{id}/tracks, in Spotify's `fields` syntax
+    track_fields: str
+    track_columns: list[str]
+    library: LibraryCache
+    scheduler: RequestScheduler
+    metrics: Metrics
+    breaker: CircuitBreaker
+    refresher: TokenRefresher
+    inflight: SingleFlight
+    search_cache: SearchCache
+
+    def __init__(self, client_id, client_secret, pool_size: int = 10, max_concurrency: int = 4, track_fields: str = "name,uri", api_base: str = "https://api.spotify.com/v1", accounts_base: str = "https://accounts.spotify.com", timeout: tuple[float, float] = (3.05, 10)):
         self.client_id = client_id
         self.client_secret = client_secret
+        self.api_base = api_base.rstrip("/")
+        self.accounts_base = accounts_base.rstrip("/")
+        self.session = self._create_session(pool_size)
+        self.max_concurrency = max_concurrency
+        self.track_fields = track_fields
+        self.track_columns = parse_columns(track_fields)
+        self.library = LibraryCache(self._get_cache_path())
+        self.metrics = Metrics()
+        self.breaker = CircuitBreaker()
+        # Prefetching gets its own, smaller budget so it never crowds out commands
+        self.scheduler = RequestScheduler(max_concurrency=pool_size, metrics=self.metrics, budgets={ "prefetch": (5, 5) }, timeout=timeout, breaker=self.breaker)
+        self.refresher = TokenRefresher(self)
+        self.inflight = SingleFlight()
+        self.search_cache = SearchCache()
+        self._refresh_lock = threading.Lock()
+
+    def _create_session(self, pool_size: int) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({ "Connection": "keep-alive" })
+        return session
+
+    def _update_auth_header(self):
+        if self.access_token is None:
+            self.session.headers.pop("Authorization", None)
+            return
+        self.session.headers["Authorization"] = f"Bearer {self.access_token}"
+
+    def _request(self, endpoint: str, method: str, url: str, **kwargs) -> requests.Response:
+        # Identical GETs already in flight share a single response. A caller
+        # joining someone else's request still gives up at its own deadline.
+        if method == "GET":
+            params = kwargs.get("params") or {}
+            key = (method, url, tuple(sorted(params.items())))
+            try:
+                return self.inflight.do(key, lambda: self._send(endpoint, method, url, **kwargs), deadline.remaining())
+            except TimeoutError:
+                raise DeadlineExceeded()
+        return self._send(endpoint, method, url, **kwargs)
+
+    def _send(self, endpoint: str, method: str, url: str, **kwargs) -> requests.Response:
+        res = self.scheduler.request(self.session, endpoint, method, url, **kwargs)
+        if not res.ok:
+            try:
+                message = res.json()['error']['message']
+            except Exception:
+                message = res.reason
+            raise SpotifyApiError(res.status_code, message)
+        return res
+
+    def stats(self) -> dict:
+        stats = self.metrics.snapshot()
+        stats["coalescing"] = self.inflight.stats()
+        stats["circuit"] = self.breaker.stats()
+        return stats
 
     @cache
     def _get_config_path(self):
@@ -27,7 +128,12 @@ class SpotifyApi:
         path = os.path.join("/".join(script_path), 'access_token.json')
         return path
 
+    def _get_cache_path(self):
+        return os.path.join(os.path.dirname(self._get_config_path()), 'library.sqlite3')
+
     def load_user(self):
+        if not os.path.exists(self._get_config_path()):
+            return
         f = open(self._get_config_path(), 'r')
         data = json.load(f)
         self.access_token = data['access_token']
@@ -35,29 +141,37 @@ class SpotifyApi:
         self.expires_in = data['expires_in']
         self.refresh_token = data['refresh_token']
         self.userId = data['user_id']
-        self.expires_at = 0
+        # Token files written before expires_at was persisted are treated as expired
+        self.expires_at = data.get('expires_at', 0)
         f.close()
-        self.refresh_access_token()
+        self._update_auth_header()
+        self.refresher.start()
 
     def save_user(self):
-        f = open(self._get_config_path(), 'w')
+        # Write to a temporary file and rename it over the old one, so other
+        # instances never read a half-written token file.
+        path = self._get_config_path()
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        f = open(tmp_path, 'w')
         json.dump({
             "access_token": self.access_token,
             "token_type": self.token_type,
             "expires_in": self.expires_in,
+            "expires_at": self.expires_at,
             "refresh_token": self.refresh_token,
             "user_id": self.userId
         }, f)
         f.flush()
+        os.fsync(f.fileno())
         f.close()
+        os.replace(tmp_path, path)
 
-    def authenticate(self, code):
-        session = requests.Session()
-        session.auth = (self.client_id, self.client_secret)
-        res = session.post("https://accounts.spotify.com/api/token", data={
+    def authenticate(self, code, redirect_uri: str = "http://localhost:8080/auth"):
+        # `redirect_uri` must be the one the authorization code was issued for
+        res = self._request("token", "POST", f"{self.accounts_base}/api/token", auth=(self.client_id, self.client_secret), data={
             "grant_type": "authorization_code",
             "code": code,
-            "redirect_uri": "http://localhost:8080/auth",
+            "redirect_uri": redirect_uri,
         }, headers={
             "Content-Type": "application/x-www-form-urlencoded",
         })
@@ -72,25 +186,64 @@ class SpotifyApi:
         self.expires_in = expires_in
         self.expires_at = math.floor(time.time() + expires_in)
         self.refresh_token = refresh_token
+        self._update_auth_header()
         userId = self._get_profile()
         self.userId = userId
 
         self.save_user()
+        self.refresher.start()
 
-    def refresh_access_token(self):
-        session = requests.Session()
-        session.auth = (self.client_id, self.client_secret)
-
-        res = session.post("https://accounts.spotify.com/api/token", data={
-            "grant_type": "refresh_token",
-            "refresh_token": self.refresh_token
-        }, headers={
-            "Content-Type": "application/x-www-form-urlencoded"
-        })
-        data = res.json()
+    def _adopt_saved_token(self) -> bool:
+        # Picks up a token that another Neovim instance refreshed in the meantime
+        if not os.path.exists(self._get_config_path()):
+            return False
+        f = open(self._get_config_path(), 'r')
+        data = json.load(f)
+        f.close()
+        expires_at = data.get('expires_at', 0)
+        if data['access_token'] == self.access_token or expires_at <= (self.expires_at or 0):
+            return False
+        # A newer token that has expired as well (e.g. after a suspend) is no use
+        if expires_at - 60 <= time.time():
+            return False
         self.access_token = data['access_token']
-        self.expires_at = math.floor(time.time() + data['expires_in'])
-        self.save_user()
+        self.expires_at = expires_at
+        self.refresh_token = data['refresh_token']
+        self._update_auth_header()
+        return True
+
+    def refresh_access_token(self, expiring_within: float | None = 60):
+        # Single-flight: threads queue on the lock and return as soon as the token
+        # they saw has been replaced, or once it no longer expires within
+        # `expiring_within` seconds (None, for the background refresher, renews
+        # regardless). The file lock extends this to other Neovim instances
+        # sharing access_token.json.
+        seen_token = self.access_token
+        with self._refresh_lock:
+            if self.access_token != seen_token:
+                return
+            # Another thread may have refreshed between our caller's expiry
+            # check and reading `seen_token`
+            if expiring_within is not None and self.expires_at is not None and self.expires_at - expiring_within >= time.time():
+                return
+            with FileLock(f"{self._get_config_path()}.lock"):
+                if self._adopt_saved_token():
+                    self.metrics.record_token_refresh(adopted=True)
+                    return
+
+                res = self._request("token", "POST", f"{self.accounts_base}/api/token", auth=(self.client_id, self.client_secret), data={
+                    "grant_type": "refresh_token",
+                    "refresh_token": self.refresh_token
+                }, headers={
+                    "Content-Type": "application/x-www-form-urlencoded"
+                })
+                data = res.json()
+                self.access_token = data['access_token']
+                self.expires_at = math.floor(time.time() + data['expires_in'])
+                self.refresh_token = data.get('refresh_token', self.refresh_token)
+                self._update_auth_header()
+                self.save_user()
+                self.metrics.record_token_refresh()
 
     def _check_expiration(self):
         if self.expires_at is None:
@@ -100,52 +253,231 @@ class SpotifyApi:
 
     def _get_profile(self):
         self._check_expiration()
-        res = requests.get("https://api.spotify.com/v1/me", headers={
-            "Authorization": f"Bearer {self.access_token}"
-        })
+        res = self._request("profile", "GET", f"{self.api_base}/me")
         data = res.json()
         return data['id']
 
+    def _fetch_page(self, endpoint: str, url: str, params: dict, offset: int, limit: int) -> dict:
+        res = self._request(endpoint, "GET", url, params={ **params, "offset": offset, "limit": limit })
+        return res.json()
+
+    def _fetch_pages(self, endpoint: str, url: str, params: dict, offsets: range, limit: int, on_page: Callable[[list], None] | None = None, concurrency: int | None = None) -> list:
+        # executor.map yields in submission order, so items keep server order
+        # and `on_page` sees the pages in order too. `concurrency` defaults to
+        # max_concurrency; with 1 the pages are fetched on this thread.
+        items = []
+        if len(offsets) == 0:
+            return items
+
+        workers = max(1, min(concurrency or self.max_concurrency, len(offsets)))
+        if workers == 1:
+            for offset in offsets:
+                page = self._fetch_page(endpoint, url, params, offset, limit)
+                items.extend(page['items'])
+                if on_page is not None:
+                    on_page(page['items'])
+            return items
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            fetch = deadline.propagate(lambda offset: self._fetch_page(endpoint, url, params, offset, limit))
+            pages = executor.map(fetch, offsets)
+            for page in pages:
+                items.extend(page['items'])
+                if on_page is not None:
+                    on_page(page['items'])
+        return items
+
+    def _get_all_pages(self, endpoint: str, url: str, limit: int, params: dict | None = None, on_page: Callable[[list], None] | None = None, concurrency: int | None = None) -> list:
+        # Read `total` from the first page, then fan out the remaining offsets.
+        params = params or {}
+        first = self._fetch_page(endpoint, url, params, 0, limit)
+        items = first['items']
+        if on_page is not None:
+            on_page(items)
+        items = items + self._fetch_pages(endpoint, url, params, range(limit, first['total'], limit), limit, on_page, concurrency)
+        return items
+
     def get_playlists(self):
         self._check_expiration()
-        res = requests.get(f"https://api.spotify.com/v1/users/{self.userId}/playlists", headers={"Authorization": f"Bearer {self.access_token}"}, params={ "limit": 50 })
-        data = res.json()
-        playlists = data['items']
-        names = [{ "name": playlist['name'], "uri": playlist['uri'], "id": playlist['id'] } for playlist in playlists]
+        playlists = self._get_all_pages("playlists", f"{self.api_base}/users/{self.userId}/playlists", 50)
+        names = [{ "name": playlist['name'], "uri": playlist['uri'], "id": playlist['id'], "snapshot_id": playlist['snapshot_id'] } for playlist in playlists]
+        self.library.save_playlists(names)
 
         return names
     
-    def get_liked_songs(self):
+    def _compact_liked_items(self, items: list) -> list:
+        return [{ "added_at": item['added_at'], "track": Track.from_api(item['track'], self.track_columns).to_dict() } for item in items]
+
+    def _load_liked_items(self, on_page: Callable[[list], None] | None) -> list:
+        items = []
+
+        def add_page(page):
+            compact = self._compact_liked_items(page)
+            items.extend(compact)
+            if on_page is not None:
+                on_page(compact)
+
+        self._get_all_pages("liked_tracks", f"{self.api_base}/me/tracks", 50, on_page=add_page)
+        self.library.save_liked_items(self.track_fields, items)
+        self.metrics.record_cache("liked_tracks", "miss")
+        return items
+
+    def _sync_liked_items(self, on_page: Callable[[list], None] | None = None) -> list:
+        # Saved tracks are returned newest first. The newest cached item is the
+        # watermark: a limit=1 probe gives `total`, so `total - len(cached)` new
+        # items must sit right above it. If the watermark is not exactly there,
+        # tracks were removed (or reordered) and the library is resynced.
+        url = f"{self.api_base}/me/tracks"
+        cached = self.library.get_liked_items(self.track_fields)
+        if not cached:
+            return self._load_liked_items(on_page)
+
+        probe = self._fetch_page("liked_tracks", url, {}, 0, 1)
+        new_count = probe['total'] - len(cached)
+        if new_count == 0:
+            head = probe['items']
+        elif 0 < new_count < 50 * self.max_concurrency:
+            head = self._fetch_pages("liked_tracks", url, {}, range(0, new_count + 1, 50), 50)
+        else:
+            head = []
+
+        def key(item):
+            return (item['added_at'], item['track']['uri'])
+
+        if not (0 <= new_count < len(head) and key(head[new_count]) == key(cached[0])):
+            return self._load_liked_items(on_page)
+
+        items = cached
+        if new_count > 0:
+            items = self._compact_liked_items(head[:new_count]) + cached
+            self.library.save_liked_items(self.track_fields, items)
+            self.metrics.record_cache("liked_tracks", "incremental")
+        else:
+            self.metrics.record_cache("liked_tracks", "hit")
+        if on_page is not None:
+            on_page(items)
+        return items
+
+    def get_liked_songs(self, on_page: Callable[[list[Track]], None] | None = None) -> list[Track]:
+        self._check_expiration()
+        on_items = None
+        if on_page is not None:
+            on_items = lambda items: on_page([Track.from_dict(item['track']) for item in items])
+        items = self._sync_liked_items(on_items)
+        return [Track.from_dict(item['track']) for item in items]
+
+    def get_currently_playing(self) -> dict | None:
+        # The compact state used by the statusline, or None when nothing is playing
         self._check_expiration()
-        res = requests.get("https://api.spotify.com/v1/me/tracks", headers={ "Authorization": f"Bearer {self.access_token}" })
+        res = self._request("player_state", "GET", f"{self.api_base}/me/player/currently-playing")
+        if res.status_code == 204 or not res.content:
+            return None
         data = res.json()
-        uris = [track['track'] for track in data['items']]
+        item = data.get('item')
+        if item is None:
+            return None
+        return {
+            "is_playing": data['is_playing'],
+            "progress_ms": data.get('progress_ms') or 0,
+            "duration_ms": item.get('duration_ms') or 0,
+            "name": item['name'],
+            "uri": item['uri'],
+            "artists": ", ".join(artist['name'] for artist in item.get('artists', [])),
+        }
+
+    def _search_result(self, type: str, item: dict) -> dict:
+        if type == "track" or type == "album":
+            artists = ", ".join(artist['name'] for artist in item.get('artists', []))
+            return { "name": f"{item['name']} - {artists}", "uri": item['uri'] }
+        if type == "playlist":
+            owner = (item.get('owner') or {}).get('display_name')
+            return { "name": f"{item['name']} - {owner}" if owner else item['name'], "uri": item['uri'] }
+        return { "name": item['name'], "uri": item['uri'] }
+
+    def search(self, query: str, type: str = "track", limit: int = 20) -> list[dict]:
+        # Results are cached per normalized query and type, so retyping or
+        # backspacing over a query does not hit the network again
+        key = (normalize_query(query), type, limit)
+        if key[0] == "":
+            return []
+        cached = self.search_cache.get(key)
+        self.metrics.record_cache("search", "miss" if cached is None else "hit")
+        if cached is not None:
+            return cached
+
+        self._check_expiration()
+        res = self._request("search", "GET", f"{self.api_base}/search", params={ "q": key[0], "type": type, "limit": limit })
+        # Spotify may return null entries in search results
+        items = [item for item in res.json()[f"{type}s"]['items'] if item is not None]
+        results = [self._search_result(type, item) for item in items]
+        self.search_cache.put(key, results)
+        return results
 
-        return uris
+    def liked_songs_context(self) -> str:
+        return f"spotify:user:{self.userId}:collection"
 
     def add_to_queue(self, uri):
         self._check_expiration()
-        requests.post("https://api.spotify.com/v1/me/player/queue", headers={ "Authorization": f"Bearer {self.access_token}" }, params={ "uri": uri })
+        self._request("player", "POST", f"{self.api_base}/me/player/queue", params={ "uri": uri })
 
     def play(self, uri: str | list[str] | None = None, offset: str | None = None):
         self._check_expiration()
         if uri is None:
-            requests.put("https://api.spotify.com/v1/me/player/play", headers={ "Authorization": f"Bearer {self.access_token}" })
-        if type(uri) is str:
+            self._request("player", "PUT", f"{self.api_base}/me/player/play")
+        elif type(uri) is str:
             if offset is None:
-                requests.put("https://api.spotify.com/v1/me/player/play", headers={ "Authorization": f"Bearer {self.access_token}" }, json={ "context_uri": uri })
+                self._request("player", "PUT", f"{self.api_base}/me/player/play", json={ "context_uri": uri })
             else:
-                requests.put("https://api.spotify.com/v1/me/player/play", headers={ "Authorization": f"Bearer {self.access_token}" }, json={ "context_uri": uri, "offset": { "uri": offset } })
+                self._request("player", "PUT", f"{self.api_base}/me/player/play", json={ "context_uri": uri, "offset": { "uri": offset } })
         else:
-            requests.put("https://api.spotify.com/v1/me/player/play", headers={ "Authorization": f"Bearer {self.access_token}" }, json={ "uris": uri })
+            self._request("player", "PUT", f"{self.api_base}/me/player/play", json={ "uris": uri })
 
     def pause(self):
         self._check_expiration()
-        requests.put("https://api.spotify.com/v1/me/player/pause", headers={ "Authorization": f"Bearer {self.access_token}" })
+        self._request("player", "PUT", f"{self.api_base}/me/player/pause")
 
-    def get_playlist_tracks(self, playlist_id: str):
+    def _get_snapshot_id(self, endpoint: str, playlist_id: str) -> str:
+        snapshot_id = self.library.get_snapshot_id(playlist_id, SNAPSHOT_MAX_AGE)
+        self.metrics.record_cache("snapshot_id", "miss" if snapshot_id is None else "hit")
+        if snapshot_id is not None:
+            return snapshot_id
+        res = self._request(endpoint, "GET", f"{self.api_base}/playlists/{playlist_id}", params={ "fields": "snapshot_id" })
+        return res.json()['snapshot_id']
+
+    def get_playlist_tracks(self, playlist_id: str, on_page: Callable[[list[Track]], None] | None = None, endpoint: str | None = None, concurrency: int | None = None) -> list[Track]:
+        # `endpoint` counts all requests (and the cache lookup) under one name
+        # instead of "playlist" and "playlist_tracks", which also gives them
+        # that endpoint's budget; `concurrency` caps the pages fetched at once
+        return self._load_playlist_tracks(playlist_id, on_page, endpoint, concurrency)[0]
+
+    def prefetch_playlist_tracks(self, playlist_id: str) -> bool:
+        # Fills the library cache in the background, one page at a time under
+        # the separately budgeted "prefetch" endpoint. Returns False when the
+        # cache was already up to date.
+        return not self._load_playlist_tracks(playlist_id, endpoint="prefetch", concurrency=1)[1]
+
+    def _load_playlist_tracks(self, playlist_id: str, on_page: Callable[[list[Track]], None] | None = None, endpoint: str | None = None, concurrency: int | None = None) -> tuple[list[Track], bool]:
+        # The tracks, and whether they came from the library cache
         self._check_expiration()
-        res = requests.get(f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks", headers={ "Authorization": f"Bearer {self.access_token}" })
-        data = res.json()
-        
-        return data['items']
+        snapshot_id = self._get_snapshot_id(endpoint or "playlist", playlist_id)
+        cached = self.library.get_tracks(playlist_id, snapshot_id, self.track_fields)
+        self.metrics.record_cache(endpoint or "playlist_tracks", "miss" if cached is None else "hit")
+        if cached is not None:
+            tracks = [Track.from_dict(track) for track in cached]
+            if on_page is not None:
+                on_page(tracks)
+            return tracks, True
+
+        tracks = []
+
+        def add_page(items):
+            # Unavailable (e.g. removed local) tracks come back as null
+            page = [Track.from_api(item['track'], self.track_columns) for item in items if item['track'] is not None]
+            tracks.extend(page)
+            if on_page is not None:
+                on_page(page)
+
+        fields = f"items(track({self.track_fields})),total"
+        self._get_all_pages(endpoint or "playlist_tracks", f"{self.api_base}/playlists/{playlist_id}/tracks", 100, { "fields": fields }, add_page, concurrency)
+        self.library.save_tracks(playlist_id, snapshot_id, self.track_fields, [track.to_dict() for track in tracks])
+        return tracks, False
@@ -0,0 +1,65 @@
+import random
+import threading
+import time
+
+# Renews the access token in the background some minutes before it expires, so
+# foreground commands only hit the token endpoint themselves when the refresher
+# could not run in time (e.g. right after the machine wakes up from suspend).
+class TokenRefresher:
+    margin: float
+    jitter: float
+    poll_interval: float
+
+    def __init__(self, api, margin: float = 300, jitter: float = 60, poll_interval: float = 60):
+        self.api = api
+        self.margin = margin
+        self.jitter = jitter
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread: threading.Thread | None = None
+        self._due_for: int | None = None
+        self._due = 0.0
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="spotify-token-refresher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def _next_due(self, expires_at: int) -> float:
+        # Jitter is drawn once per token so that the deadline does not move around.
+        # Short-lived tokens are renewed halfway through their remaining lifetime.
+        if self._due_for != expires_at:
+            self._due_for = expires_at
+            due = expires_at - self.margin - random.uniform(0, self.jitter)
+            self._due = max(due, (time.time() + expires_at) / 2)
+        return self._due
+
+    def _run(self):
+        while not self._stopped:
+            expires_at = self.api.expires_at
+            if expires_at is None or self.api.refresh_token is None:
+                self._sleep(self.poll_interval)
+                continue
+
+            # Wait in bounded steps and re-read the wall clock each time, since a
+            # suspended machine does not advance monotonic timers.
+            delay = self._next_due(expires_at) - time.time()
+            if delay > 0:
+                self._sleep(min(delay, self.poll_interval))
+                continue
+
+            try:
+                self.api.refresh_access_token(expiring_within=None)
+            except Exception:
+                self._sleep(min(30, self.poll_interval))
+
+    def _sleep(self, seconds: float):
+        self._wake.wait(seconds)
+        self._wake.clear()
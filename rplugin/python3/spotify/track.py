@@ -0,0 +1,49 @@
+def parse_columns(fields: str) -> list[str]:
+    # Top-level keys of a Spotify `fields` expression, e.g.
+    # "name,uri,artists(name)" -> ["name", "uri", "artists"]
+    columns = []
+    depth = 0
+    current = ""
+    for c in fields:
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "," and depth == 0:
+            columns.append(current.strip())
+            current = ""
+            continue
+        if depth == 0 and c != ")":
+            current += c
+    columns.append(current.strip())
+    return [column for column in columns if column]
+
+# The part of a Spotify track object the pickers actually use. Only `name` and
+# `uri` are always kept; other columns (see g:spotify_track_fields) go into
+# `extra`, so the default record is two strings instead of a multi-KB object.
+class Track:
+    __slots__ = ("name", "uri", "extra")
+
+    name: str
+    uri: str
+    extra: dict | None
+
+    def __init__(self, name: str, uri: str, extra: dict | None = None):
+        self.name = name
+        self.uri = uri
+        self.extra = extra
+
+    @classmethod
+    def from_api(cls, track: dict, columns: list[str]) -> "Track":
+        extra = { column: track.get(column) for column in columns if column != "name" and column != "uri" }
+        return cls(track['name'], track['uri'], extra or None)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Track":
+        extra = { key: value for key, value in data.items() if key != "name" and key != "uri" }
+        return cls(data['name'], data['uri'], extra or None)
+
+    def to_dict(self) -> dict:
+        if self.extra is None:
+            return { "name": self.name, "uri": self.uri }
+        return { "name": self.name, "uri": self.uri, **self.extra }